@@ -0,0 +1,197 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from main import print_with_color, banner_top, banner_btm
+
+# 生成模拟的 CVK 主机日志和配置目录, 在上面运行完整的收集流程, 不需要真实的 CVK 主机
+
+main_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+# 各个日志目录占总大小的比例和文件数量
+log_components = {
+    'libvirt/qemu': (0.15, 8),
+    'ovn': (0.15, 4),
+    'openvswitch': (0.15, 4),
+    'frr': (0.05, 3),
+    'cvk-ha': (0.1, 4),
+    'network-cvk-agent': (0.1, 4),
+    'network-audit-agent': (0.05, 2),
+}
+# messages 和 libvirtd.log 单独生成, 剩下的比例
+messages_share = 0.15
+libvirtd_share = 0.1
+
+log_words = [
+    'info', 'info', 'info', 'info', 'debug', 'debug', 'warning',
+    'error', 'failed', 'not found', 'unhealthy',
+]
+
+config_files = {
+    '/etc/cvk-agent/cvk-agent.yaml': 'agent:\n  port: 9200\n',
+    '/etc/network-cvk-agent/config.json': '{"log_level": "info"}\n',
+    '/etc/network-audit-agent/config.json': '{"audit": true}\n',
+    '/etc/frr/bgpd.conf': 'router bgp 65001\n',
+    '/etc/cvk-ha/cvk-ha.yaml': 'ha:\n  enable: true\n',
+    '/etc/cas_cvk-version': 'CAS-CVK E0785\n',
+}
+
+# 替代真实命令的脚本, 放在 PATH 最前面
+shims = {
+    'rpm': 'for p in cvk-agent network-cvk-agent openvswitch ovn frr cvk-ha libvirt qemu-kvm; do echo "$p-1.0-1.x86_64"; done\n',
+    'systemctl': 'shift; for s in "$@"; do echo active; done\n',
+    'dmesg': 'i=0; while [ $i -lt 2000 ]; do echo "[ $i.000000] kernel: bench line $i"; i=$((i+1)); done\n',
+    # 忽略 ssh 的选项, 在本机执行远程命令
+    'ssh': ('while [ $# -gt 0 ]; do\n'
+            '  case "$1" in\n'
+            '    -o) shift 2;;\n'
+            '    -O) exit 0;;\n'
+            '    -*) shift;;\n'
+            '    *) break;;\n'
+            '  esac\n'
+            'done\n'
+            'shift\n'
+            'exec sh -c "$*"\n'),
+}
+
+def write_log(path, size, style, start, rng):
+    # 按时间顺序写日志行, 直到文件达到 size 字节
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    opener = gzip.open if path.endswith('.gz') else open
+    written = 0
+    when = start
+    lines = []
+    with opener(path, 'wb') as log_file:
+        while written < size:
+            when += timedelta(milliseconds=rng.randint(1, 2000))
+            word = rng.choice(log_words)
+            if style == 'syslog':
+                line = f"{when:%b %d %H:%M:%S} cvknode {word}: bench message {written}\n"
+            elif style == 'libvirt':
+                line = f"{when:%Y-%m-%d %H:%M:%S}.{when.microsecond // 1000:03d}+0000: 4242: {word} : bench message {written}\n"
+            else:
+                line = f"{when:%Y-%m-%dT%H:%M:%S}.{when.microsecond:06d}Z {word}: bench message {written}\n"
+            lines.append(line)
+            written += len(line)
+            if len(lines) >= 4096:
+                log_file.write(''.join(lines).encode())
+                lines = []
+        log_file.write(''.join(lines).encode())
+
+def generate_tree(root, size_mb, seed):
+    rng = random.Random(seed)
+    total = size_mb * 1024 * 1024
+    start = datetime.now() - timedelta(days=2)
+
+    write_log(f"{root}/var/log/messages", int(total * messages_share), 'syslog', start, rng)
+    write_log(f"{root}/var/log/messages-{start - timedelta(days=1):%Y%m%d}.gz",
+              int(total * messages_share / 4), 'syslog', start - timedelta(days=1), rng)
+    write_log(f"{root}/var/log/libvirt/libvirtd.log", int(total * libvirtd_share), 'libvirt', start, rng)
+
+    for component, (share, files) in log_components.items():
+        style = 'iso' if component == 'libvirt/qemu' else 'syslog'
+        for i in range(files):
+            write_log(f"{root}/var/log/{component}/{component.split('/')[-1]}-{i}.log",
+                      int(total * share / files), style, start, rng)
+
+    # 超出收集天数的旧日志, 不应该被收集
+    old_log = f"{root}/var/log/ovn/ovn-old.log"
+    write_log(old_log, 64 * 1024, 'syslog', start - timedelta(days=30), rng)
+    old_mtime = time.time() - 30 * 86400
+    os.utime(old_log, (old_mtime, old_mtime))
+
+    for path, content in config_files.items():
+        os.makedirs(os.path.dirname(root + path), exist_ok=True)
+        with open(root + path, 'w') as config_file:
+            config_file.write(content)
+
+    os.makedirs(f"{root}/var/lib/cvk-ha", exist_ok=True)
+    with open(f"{root}/var/lib/cvk-ha/nodes.json", 'w') as nodes_file:
+        json.dump({'MasterNode': {'ManageIp': '127.0.0.1'}, 'Nodes': [{'ManageIp': '127.0.0.1'}]}, nodes_file)
+
+    bin_dir = f"{root}/bin"
+    os.makedirs(bin_dir, exist_ok=True)
+    for name, script in shims.items():
+        shim_path = os.path.join(bin_dir, name)
+        with open(shim_path, 'w') as shim_file:
+            shim_file.write('#!/bin/sh\n' + script)
+        os.chmod(shim_path, 0o755)
+
+def tree_size(root):
+    total = 0
+    for top in ('var', 'etc'):
+        for dirpath, _, files in os.walk(os.path.join(root, top)):
+            total += sum(os.path.getsize(os.path.join(dirpath, f)) for f in files)
+    return total
+
+def run_collector(root, output, extra_args):
+    env = dict(os.environ)
+    env['PATH'] = f"{root}/bin:{env.get('PATH', '')}"
+    args = [sys.executable, main_script, '--root', root, '--days', '3', '--project', 'bench',
+            '--output', output, '--ssh', f"{root}/bin/ssh", '--state-dir', f"{root}/state", *extra_args]
+
+    start = time.monotonic()
+    proc = subprocess.run(args, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.monotonic() - start
+    if proc.returncode:
+        sys.stderr.write(proc.stderr.decode(errors='replace'))
+        raise SystemExit(f"collector exited with {proc.returncode}")
+
+    with tarfile.open(output) as bundle:
+        for member in bundle:
+            if member.name.endswith('/timings.json'):
+                return elapsed, json.load(bundle.extractfile(member))
+    return elapsed, None
+
+def print_result(run, elapsed, input_size, output, timings):
+    output_size = os.path.getsize(output)
+    print_with_color(banner_top, "cyan")
+    print_with_color(f"Run {run}: {elapsed:.2f}s, input {input_size / 1048576:.1f} MB, "
+                     f"bundle {output_size / 1048576:.1f} MB, {input_size / 1048576 / elapsed:.1f} MB/s", "green")
+    if timings:
+        print(f"cpu {timings['cpu_time']:.2f}s, peak rss {timings['peak_rss_kb']} KB, "
+              f"children cpu {timings['children_cpu_time']:.2f}s")
+        if 'throttle' in timings:
+            print(f"throttled {timings['throttle']['throttled_time']:.2f}s, "
+                  f"{timings['throttle']['backoffs']} load backoffs")
+        print(f"{'collector':<28} {'wall':>8} {'read MB':>9} {'added MB':>9} {'child cpu':>10} {'throttled':>10}")
+        for c in sorted(timings['collectors'], key=lambda c: c['wall_time'], reverse=True):
+            print(f"{c['id']:<28} {c['wall_time']:8.2f} {c['bytes_read'] / 1048576:9.2f} "
+                  f"{c['bytes_added'] / 1048576:9.2f} {c['child_cpu_time']:10.2f} {c['throttled_time']:10.2f}")
+    print_with_color(banner_btm, "cyan")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the CVK log collector on a synthetic log tree",
+                                     epilog="arguments after -- are passed to main.py, e.g. -- --jobs 8 --compress xz")
+    parser.add_argument('--size-mb', type=int, default=256, help="total size of the synthetic logs (default 256)")
+    parser.add_argument('--runs', type=int, default=1, help="number of collector runs (default 1)")
+    parser.add_argument('--seed', type=int, default=1, help="random seed of the synthetic logs")
+    parser.add_argument('--root', help="reuse or keep the synthetic tree in this directory")
+    args, extra_args = parser.parse_known_args()
+    if extra_args[:1] == ['--']:
+        extra_args = extra_args[1:]
+
+    root = os.path.abspath(args.root) if args.root else tempfile.mkdtemp(prefix='cvk-bench-')
+    try:
+        if not os.path.exists(os.path.join(root, 'var')):
+            print_with_color(f"Generating {args.size_mb} MB synthetic logs in {root}...", "green")
+            generate_tree(root, args.size_mb, args.seed)
+        input_size = tree_size(root)
+
+        for run in range(1, args.runs + 1):
+            output = os.path.join(root, f"bench-{run}.tar.gz")
+            elapsed, timings = run_collector(root, output, extra_args)
+            print_result(run, elapsed, input_size, output, timings)
+            os.remove(output)
+    finally:
+        if not args.root:
+            shutil.rmtree(root)
@@ -1,16 +1,97 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from contextlib import contextmanager
 from pathlib import Path
 import socket
 import os
 from os.path import isdir
+import sys
 import subprocess
 import tempfile
 import tarfile
 import json
+import stat
+import threading
+import io
+import re
+import glob
+import shlex
+import hashlib
+import resource
+import mmap
 import shutil
+import gzip
+import bz2
+import lzma
 import time
+import signal
+import traceback
+import zlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 g_last_ndays = 3
+# 主机文件系统的根目录, 为空表示 /
+g_root = ''
+# 并发执行的收集任务数量
+g_max_workers = 4
+# 单个收集任务的超时时间(秒)
+g_collector_timeout = 600
+# 单个挂载点 statvfs 的超时时间(秒)
+g_statvfs_timeout = 10
+# 流式复制时每次读写的块大小
+g_chunk_size = 1024 * 1024
+# 每个日志目录和所有日志目录合计最多打包的字节数, 0 表示不限制
+g_component_budget = 1024 * 1024 * 1024
+g_total_budget = 4 * 1024 * 1024 * 1024
+# --since/--until 指定的时间窗口(时间戳), None 表示不限制
+g_since = None
+g_until = None
+# 增量收集的状态, None 表示不使用增量模式
+g_incremental = None
+# 增量收集状态文件所在目录
+g_state_dir = '/var/lib/cvk-log-collector'
+# 增量收集记录偏移之前这么多字节的 sha256, 用来识别 copytruncate 轮转后重新写到原大小的文件
+g_fingerprint_size = 4096
+# ssh 命令, 可以替换成测试用的本地脚本
+g_ssh_command = ['ssh']
+# ssh ControlMaster 连接的 socket 目录
+g_ssh_control_dir = tempfile.gettempdir()
+# 集群模式下同时收集的节点数量和单个节点的超时时间(秒)
+g_cluster_workers = 4
+g_node_timeout = 3600
+# 作为集群中的一个节点被远程调用
+g_cluster_node = False
+# 扫描错误信息时每种错误信息保留的样例行数
+g_max_samples = 20
+# 扫描错误信息时单行最多保留的字节数, 超长行剩余的部分不扫描
+g_max_scan_line = 8 * 1024
+# 去重索引中的记录保留天数
+g_dedup_keep_days = 30
+# 命令输出在内存中缓存的上限, 超过后写入临时文件
+g_spool_size = 8 * 1024 * 1024
+# 打包文件所在目录, 缓存超过上限时的临时文件也写在这里, 避免占满较小的 /tmp
+g_output_dir = '.'
+# --throttle 模式下的 Throttle, None 表示不限速
+g_throttle = None
+# --throttle 模式的默认参数: nice 值、读取带宽(MB/s)、每个 CPU 的 1 分钟负载、PSI avg10 百分比
+g_throttle_nice = 10
+g_throttle_read_mb = 32
+g_throttle_max_load = 1.0
+g_throttle_max_pressure = 20.0
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 打包压缩格式: 扩展名, 默认压缩级别
+compress_codecs = {
+    'gz': ('.tar.gz', 6),
+    'xz': ('.tar.xz', 6),
+    'bz2': ('.tar.bz2', 9),
+    'zst': ('.tar.zst', 3),
+    'none': ('.tar', None),
+}
 
 banner_top = "============================================================================="
 banner_btm = "============================================================================="
@@ -21,7 +102,7 @@ common_err_msgs = {
     "failed",
     "fail",
     "failure",
-    "not found"
+    "not found",
     "unhealthy",
 }
 
@@ -45,228 +126,2047 @@ def print_with_color(text, color):
         print(text)
 
 
-def cleanup_recent_tar_files(project_name, directory, minutes=10):
-    current_time = time.time()
-    cutoff_time = current_time - (minutes * 60)
+def host_path(path):
+    # 在 --root 指定的目录下读取日志和配置, 用于在模拟的日志目录上测试
+    return g_root + path if g_root else path
+
+def is_local_address(ip):
+    # 能绑定的地址就是本机地址
+    try:
+        with socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((ip, 0))
+        return True
+    except OSError:
+        return False
+
+def get_cvk_master_ip():
+    return json.load(open(host_path('/var/lib/cvk-ha/nodes.json')))['MasterNode']['ManageIp']
 
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.tar.gz'):
-                file_path = os.path.join(root, file)
-                file_stat = os.stat(file_path)
-                file_mtime = file_stat.st_mtime
+# 主机和服务信息在进程内直接读取 /proc、os.statvfs 和配置文件, 不再为每一项启动 shell
+# 每个信息收集项返回 (文本, 结构化数据), 分别保存为原来的文本文件和同名的 .json 文件
 
-                if file_mtime >= cutoff_time:
-                    os.remove(file_path)
-                    print_with_color(f"Deleted recent tar file: {file_path}", "yellow")
+g_services = ('cvk-agent', 'cvk-ha', 'network-cvk-agent', 'openvswitch', 'ovn-northd', 'frr')
+network_packages_re = re.compile(r'cvk-agent|network-cvk-agent|openvswitch|ovn|frr')
+compute_packages_re = re.compile(r'cvk-agent|cvk-ha')
 
-    # 删除对应目录
-    os.system(f'rm -rf {project_name}')
+# 这些文件系统的 statvfs 在服务端无响应时会一直阻塞
+network_fs_types = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ceph', 'glusterfs', 'lustre', 'afs', '9p'}
 
-def get_cvk_master_ip():
-    return json.load(open('/var/lib/cvk-ha/nodes.json'))['MasterNode']['ManageIp']
+# rpm -qa 需要扫描整个 RPM 数据库, 网络和计算组件版本共用一次查询结果
+g_rpm_lock = threading.Lock()
+g_rpm_packages = None
+
+def format_facts(sections):
+    lines = [banner_top]
+    for title, section_lines in sections:
+        lines.append(f"{title}:")
+        lines.extend(section_lines)
+        lines.append(banner_btm)
+    return "\n".join(lines) + "\n"
+
+def run_command_output(args, check=True):
+    buf = io.BytesIO()
+    run_command_to_file(args, buf, g_collector_timeout, check)
+    return buf.getvalue().decode(errors='replace')
+
+def rpm_packages():
+    global g_rpm_packages
+    with g_rpm_lock:
+        if g_rpm_packages is None:
+            g_rpm_packages = sorted(run_command_output(['rpm', '-qa']).split())
+        return g_rpm_packages
+
+def read_proc_fields(path):
+    # /proc/meminfo 和 /proc/cpuinfo 都是 "名称: 值" 的格式, 同名字段只保留第一个
+    fields = {}
+    with open(path) as proc_file:
+        for line in proc_file:
+            name, sep, value = line.partition(':')
+            if sep:
+                fields.setdefault(name.strip(), value.strip())
+    return fields
+
+def human_size(size):
+    # 与 df -h / free -h 相同的 1024 进制单位
+    for unit in ('B', 'K', 'M', 'G', 'T'):
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    if unit == 'B':
+        return f"{size}B"
+    return f"{size:.1f}{unit}" if size < 10 else f"{size:.0f}{unit}"
+
+def statvfs_with_timeout(path, timeout):
+    # 共享存储池的挂载点(ocfs2、iscsi 上的文件系统等)在存储异常时 statvfs 也会阻塞
+    # 在后台线程中查询, 超时后放弃这个挂载点, 收集线程不会被一直卡住
+    result = {}
+
+    def probe():
+        try:
+            result['st'] = os.statvfs(path)
+        except OSError as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=probe, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"statvfs {path} timed out after {timeout:.0f}s")
+    if 'error' in result:
+        raise result['error']
+    return result['st']
 
-def run_commands_and_collect_logs(temp_dir, log_types):
-    # @ [0]是要执行的命令
-    # @ [1:-1]是命令的参数
-    # @ [-1] 是要将命令输出结果保存的文件名称
+def disk_facts():
+    # 网络文件系统只记录挂载信息, 不查询容量; 其他挂载点逐个查询, 合计不超过收集项的超时时间
+    disks = []
+    deadline = time.monotonic() + g_collector_timeout
+    with open('/proc/mounts') as mounts:
+        for line in mounts:
+            device, mount_point, fs_type = line.split()[:3]
+            # 挂载点中的空格等字符以 \040 形式转义
+            mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), mount_point)
+            disk = {'filesystem': device, 'type': fs_type, 'mount_point': mount_point,
+                    'size': None, 'used': None, 'available': None}
+            if fs_type in network_fs_types or fs_type.startswith('fuse.'):
+                disk['error'] = 'network filesystem, not queried'
+                disks.append(disk)
+                continue
 
+            timeout = min(g_statvfs_timeout, deadline - time.monotonic())
+            try:
+                if timeout <= 0:
+                    raise TimeoutError("collector timeout exceeded")
+                st = statvfs_with_timeout(mount_point, timeout)
+            except TimeoutError as e:
+                print_with_color(f"Skipping disk info of {mount_point}: {e}", "red")
+                disk['error'] = str(e)
+                disks.append(disk)
+                continue
+            except OSError:
+                continue
+            # 与 df 一样跳过 proc/sysfs 等没有块的伪文件系统
+            if st.f_blocks == 0:
+                continue
+            disk.update({
+                'size': st.f_blocks * st.f_frsize,
+                'used': (st.f_blocks - st.f_bfree) * st.f_frsize,
+                'available': st.f_bavail * st.f_frsize,
+            })
+            disks.append(disk)
+    return disks
+
+def memory_facts():
+    meminfo = read_proc_fields('/proc/meminfo')
+
+    def kb(name):
+        return int(meminfo.get(name, '0').split()[0]) * 1024
+
+    buff_cache = kb('Buffers') + kb('Cached') + kb('SReclaimable')
+    return {
+        'total': kb('MemTotal'),
+        'used': kb('MemTotal') - kb('MemFree') - buff_cache,
+        'free': kb('MemFree'),
+        'shared': kb('Shmem'),
+        'buff_cache': buff_cache,
+        'available': kb('MemAvailable'),
+        'swap_total': kb('SwapTotal'),
+        'swap_used': kb('SwapTotal') - kb('SwapFree'),
+        'swap_free': kb('SwapFree'),
+    }
+
+def cpu_facts():
+    cpuinfo = read_proc_fields('/proc/cpuinfo')
+    with open('/proc/cpuinfo') as proc_file:
+        count = sum(1 for line in proc_file if line.startswith('processor'))
+    return {
+        'architecture': os.uname().machine,
+        'vendor_id': cpuinfo.get('vendor_id'),
+        'model_name': cpuinfo.get('model name'),
+        'count': count,
+    }
+
+def host_facts():
+    uname = os.uname()
+    try:
+        with open(host_path('/etc/cas_cvk-version')) as version_file:
+            cvk_version = version_file.read().strip()
+    except OSError:
+        cvk_version = None
+
+    data = {
+        'hostname': socket.gethostname(),
+        'kernel': {'sysname': uname.sysname, 'release': uname.release,
+                   'version': uname.version, 'machine': uname.machine},
+        'disks': disk_facts(),
+        'memory': memory_facts(),
+        'cvk_version': cvk_version,
+        'cpu': cpu_facts(),
+    }
+
+    disk_lines = [f"{'Filesystem':<32} {'Size':>6} {'Used':>6} {'Avail':>6} {'Use%':>5} Mounted on"]
+    for disk in data['disks']:
+        if disk['size'] is None:
+            disk_lines.append(f"{disk['filesystem']:<32} {'-':>6} {'-':>6} {'-':>6} {'-':>5} {disk['mount_point']} "
+                              f"({disk['error']})")
+            continue
+        usable = disk['used'] + disk['available']
+        use = f"{-(-disk['used'] * 100 // usable)}%" if usable else '-'
+        disk_lines.append(f"{disk['filesystem']:<32} {human_size(disk['size']):>6} {human_size(disk['used']):>6} "
+                          f"{human_size(disk['available']):>6} {use:>5} {disk['mount_point']}")
+
+    mem = data['memory']
+    mem_lines = [f"{'':<6} {'total':>8} {'used':>8} {'free':>8} {'shared':>8} {'buff/cache':>10} {'available':>9}",
+                 f"{'Mem:':<6} {human_size(mem['total']):>8} {human_size(mem['used']):>8} {human_size(mem['free']):>8} "
+                 f"{human_size(mem['shared']):>8} {human_size(mem['buff_cache']):>10} {human_size(mem['available']):>9}",
+                 f"{'Swap:':<6} {human_size(mem['swap_total']):>8} {human_size(mem['swap_used']):>8} "
+                 f"{human_size(mem['swap_free']):>8}"]
+
+    cpu = data['cpu']
+    cpu_lines = [f"Architecture: {cpu['architecture']}"]
+    if cpu['vendor_id']:
+        cpu_lines.append(f"Vendor ID: {cpu['vendor_id']}")
+    if cpu['model_name']:
+        cpu_lines.append(f"Model name: {cpu['model_name']}")
+
+    text = format_facts([
+        ("Host Info", [data['hostname']]),
+        ("Kernel Version", [f"{uname.sysname} {uname.nodename} {uname.release} {uname.version} {uname.machine}"]),
+        ("Disk Info", disk_lines),
+        ("Mem Info", mem_lines),
+        ("CVK Version", [cvk_version or '']),
+        ("CPU Info", cpu_lines),
+    ])
+    return text, data
+
+def service_facts():
+    # 一次 systemctl is-active 查询所有服务, 每个服务输出一行状态
+    # 有服务不是 active 时 systemctl 返回非 0, 不作为错误
+    states = run_command_output(['systemctl', 'is-active', *g_services], check=False).split()
+    data = {service: states[i] if i < len(states) else 'unknown' for i, service in enumerate(g_services)}
+    lines = [banner_top, "Service Status:", *(f"{service}: {state}" for service, state in data.items()), banner_btm]
+    return "\n".join(lines) + "\n", data
+
+def component_version_facts(title, packages_re):
+    packages = [package for package in rpm_packages() if packages_re.search(package)]
+    return format_facts([(title, packages)]), {'packages': packages}
+
+def network_version_facts():
+    return component_version_facts("Network Component Versions", network_packages_re)
+
+def compute_version_facts():
+    return component_version_facts("Compute Component Versions", compute_packages_re)
+
+def build_collectors():
+    # 收集项注册表，每一项有固定的id:
+    # @ cmd    要执行的命令及参数, 输出直接写入打包文件
+    # @ facts  在进程内收集信息的函数, 返回文本和结构化数据, 分别保存为 file 和 file.json
+    # @ source 直接打包的本地文件, 不需要再启动 cat
+    # @ paths  直接打包的日志目录, 不再生成中间 tar.gz
+    # @ file   命令输出结果保存的文件名称, paths 类型为打包后的目录名称
+    # @ dir    保存到 log/config/info 哪个目录
+    # @ groups 属于哪些日志类型, common 表示所有类型都需要
+    # @ inputs 读取的本地文件或目录, 用于 dry-run 估算输入大小, source 默认就是输入
+    # @ recent 是否只收集最近 g_last_ndays 天修改过的文件
+    # @ timed  日志行带时间戳, 指定 --since/--until 时只打包时间窗口内的部分
 
     try:
         cvk_master_ip = get_cvk_master_ip()
     except Exception as e:
+        cvk_master_ip = None
         print_with_color(f"Failed to get master ip: {e}", "red")
-        # return
 
-    common_commands = [
+    collectors = [
 
         # 服务状态
-        ['bash', '-c', f'echo "{banner_top}\nService Status:"; for service in cvk-agent cvk-ha network-cvk-agent openvswitch ovn-northd frr; do echo "$service: $(systemctl is-active $service)"; done; echo {banner_btm}', 'network-service-status', 'info'],
+        {'id': 'service-status', 'groups': ('common',), 'dir': 'info', 'file': 'network-service-status',
+         'facts': service_facts},
 
         # 日志文件
         # TODO: convert dmesg timestap
-        ['dmesg', 'dmesg-log', 'log'], 
-        ['cat', '/var/log/messages', 'messages', 'log'],
-        ['cat', '/var/log/dmesg.old', 'dmesg.old', 'log'], 
+        {'id': 'dmesg', 'groups': ('common',), 'dir': 'log', 'file': 'dmesg-log',
+         'cmd': ['dmesg']},
+        {'id': 'messages', 'groups': ('common',), 'dir': 'log', 'file': 'messages',
+         'source': host_path('/var/log/messages'), 'timed': True},
+        {'id': 'dmesg-old', 'groups': ('common',), 'dir': 'log', 'file': 'dmesg.old',
+         'source': host_path('/var/log/dmesg.old')},
+
+        # 主机信息
+        {'id': 'host-info', 'groups': ('common',), 'dir': 'info', 'file': 'host-info',
+         'facts': host_facts, 'inputs': [host_path('/etc/cas_cvk-version')]},
+
+        # network-cvk-agent
+        {'id': 'network-cvk-agent-log', 'groups': ('network',), 'dir': 'log', 'file': 'network-cvk-agent',
+         'paths': [host_path('/var/log/network-cvk-agent/')], 'recent': True},
+        # network-audit-agent
+        {'id': 'network-audit-agent-log', 'groups': ('network',), 'dir': 'log', 'file': 'network-audit-agent',
+         'paths': [host_path('/var/log/network-audit-agent/')], 'recent': True},
+        # frr
+        {'id': 'frr-log', 'groups': ('network',), 'dir': 'log', 'file': 'frr',
+         'paths': [host_path('/var/log/frr/')], 'recent': True},
+        # ovn
+        {'id': 'ovn-log', 'groups': ('network',), 'dir': 'log', 'file': 'ovn',
+         'paths': [host_path('/var/log/ovn/')], 'recent': True},
+        # openvswitch
+        {'id': 'openvswitch-log', 'groups': ('network',), 'dir': 'log', 'file': 'openvswitch',
+         'paths': [host_path('/var/log/openvswitch/')], 'recent': True},
 
         # 配置文件
+        {'id': 'cvk-agent-config', 'groups': ('network',), 'dir': 'config', 'file': 'cvk-agent-yaml',
+         'source': host_path('/etc/cvk-agent/cvk-agent.yaml')},
+        {'id': 'network-cvk-agent-config', 'groups': ('network',), 'dir': 'config', 'file': 'network-cvk-agent-config',
+         'source': host_path('/etc/network-cvk-agent/config.json')},
+        {'id': 'network-audit-agent-config', 'groups': ('network',), 'dir': 'config', 'file': 'network-audit-agent-config',
+         'source': host_path('/etc/network-audit-agent/config.json')},
+        {'id': 'frr-config', 'groups': ('network',), 'dir': 'config', 'file': 'frr-config',
+         'source': host_path('/etc/frr/bgpd.conf')},
 
-        # 主机信息
-    #     ['sh', '-c', 
-    #      f'''
-    #         echo "{banner_top}";
-    #         echo -e "Host Info:\n\n$(hostname)\n\nKernel Version:\n\n$(uname -a)\n\nDisk Info:\n\n$(df -h)\n\nMem Info:\n\n$(free -h)\n\nCVK Version:\n\n$(cat /etc/cas_cvk-version)\n\nCPU Info:\n\n$(lscpu | grep -E "Architecture|Vendor ID|Model name")\n\n;echo {banner_btm}"''', 
-    #      'host-info', 'info'],
-    # ]
-        ['sh', '-c', 
-         f'''
-            echo -e "{banner_top}\nHost Info:\n$(hostname)\n{banner_btm}\nKernel Version:\n$(uname -a)\n{banner_btm}\nDisk Info:\n$(df -h)\n{banner_btm}\nMem Info:\n$(free -h)\n{banner_btm}\nCVK Version:\n$(cat /etc/cas_cvk-version)\n{banner_btm}\nCPU Info:\n$(lscpu | grep -E "Architecture|Vendor ID|Model name")\n{banner_btm}\n
-            "
-        ''', 
-         'host-info', 'info'],
+        # 版本信息
+        {'id': 'network-version', 'groups': ('network',), 'dir': 'info', 'file': 'network-component-version',
+         'facts': network_version_facts},
+
+        # 计算日志文件
+        {'id': 'cvk-ha-log', 'groups': ('compute',), 'dir': 'log', 'file': 'cvk-ha',
+         'paths': [host_path('/var/log/cvk-ha/')], 'recent': True},
+        {'id': 'libvirt-log', 'groups': ('compute',), 'dir': 'log', 'file': 'libvirt.log',
+         'source': host_path('/var/log/libvirt/libvirtd.log'), 'timed': True},
+        {'id': 'qemu-log', 'groups': ('compute',), 'dir': 'log', 'file': 'qemu',
+         'paths': [host_path('/var/log/libvirt/qemu/')], 'timed': True},
+
+        # 计算配置文件
+        {'id': 'cvk-ha-config', 'groups': ('compute',), 'dir': 'config', 'file': 'cvk-ha-yaml',
+         'source': host_path('/etc/cvk-ha/cvk-ha.yaml')},
+
+        # 计算版本信息
+        {'id': 'compute-version', 'groups': ('compute',), 'dir': 'info', 'file': 'compute-component-version',
+         'facts': compute_version_facts},
     ]
 
-    commands = {
-        'all': [],
-        'network': [
-
-            # network-cvk-agent
-            ['sh', '-c', f'find /var/log/network-cvk-agent/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/network-cvk-agent.tar.gz -T - && cat /tmp/network-cvk-agent.tar.gz', 'network-cvk-agent.tar.gz', 'log'],
-            # network-audit-agent
-            ['sh', '-c', f'find /var/log/network-audit-agent/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/network-audit-agent.tar.gz -T - && cat /tmp/network-audit-agent.tar.gz', 'network-audit-agent.tar.gz', 'log'],
-            # frr
-            ['sh', '-c', f'find /var/log/frr/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/frr.tar.gz -T - && cat /tmp/frr.tar.gz', 'frr.tar.gz', 'log'],
-
-            # ovn
-            ['sh', '-c', f'find /var/log/ovn/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/ovn.tar.gz -T - && cat /tmp/ovn.tar.gz', 'ovn.tar.gz', 'log'],
-            
-            # openvswitch
-            ['sh', '-c', f'find /var/log/openvswitch/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/openvswitch.tar.gz -T - && cat /tmp/openvswitch.tar.gz', 'openvswitch.tar.gz', 'log'],
-
-            # 配置文件
-            ['cat', '/etc/cvk-agent/cvk-agent.yaml', 'cvk-agent-yaml', 'config'],
-            ['cat', '/etc/network-cvk-agent/config.json', 'network-cvk-agent-config', 'config'],
-            ['cat', '/etc/network-audit-agent/config.json', 'network-audit-agent-config', 'config'],
-            ['cat', '/etc/frr/bgpd.conf', 'frr-config', 'config'],
-
-            # 版本信息
-            ['sh', '-c', f'echo -e "{banner_top}\nNetwork Component Versions:\n$(rpm -qa | grep -E "cvk-agent|network-cvk-agent|openvswitch|ovn|frr")\n{banner_btm}\n"', 'cvk-agent', 'network-component-version', 'info'],
-            # 其他信息
-        ],
-        'compute': [
-            # 日志文件
-            ['sh', '-c', f'find /var/log/cvk-ha/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/cvk-ha.tar.gz -T - && cat /tmp/cvk-ha.tar.gz', 'cvk-ha.tar.gz', 'log'],
-
-            # 获取master节点cvk-ha日志
-            # ['sh', '-c', f'master_ip=$(python3 -c "import json; print(f\"{json.load(open('/var/lib/cvk-ha/nodes.json'))['MasterNode']['ManageIp']}\")"); G_LAST_NDAYS={g_last_ndays}; ssh root@$master_ip "find /var/log/cvk-ha/ -type f -mtime -$G_LAST_NDAYS  | tar -czf /tmp/cvk-master-ha.tar.gz -T - && cat /tmp/cvk-master-ha.tar.gz"', 'log'],
-
-            ['sh', '-c', f'ssh root@{cvk_master_ip} "find /var/log/cvk-ha/ -type f -mtime -{g_last_ndays} | tar -czf /tmp/cvk-master-ha.tar.gz -T - && cat /tmp/cvk-master-ha.tar.gz"', 'cvk-master-ha-log.tar.gz', 'log'],
-
-            ['cat', '/var/log/libvirt/libvirtd.log', 'libvirt.log', 'log'],
-            ['sh', '-c', 'tar -czf /tmp/qemu.tar.gz /var/log/libvirt/qemu && cat /tmp/qemu.tar.gz', 'qemu.tar.gz', 'log'],
-
-            # 配置文件
-            ['cat', '/etc/cvk-ha/cvk-ha.yaml', 'cvk-ha-yaml', 'config'],
-
-            # 版本信息
-            ['sh', '-c', f'echo -e "{banner_top}\nCompute Component Versions:\n$(rpm -qa | grep -E "cvk-agent|cvk-ha")\n{banner_btm}\n"', 'compute-component-version', 'info'],
-            # 其他信息
-        ],
-    }
+    # 获取master节点cvk-ha日志, 集群模式下master节点自己会收集, 本机就是master时和本机cvk-ha日志重复
+    if cvk_master_ip and not g_cluster_node and not is_local_address(cvk_master_ip):
+        collectors.append(
+            {'id': 'cvk-master-ha-log', 'groups': ('compute',), 'dir': 'log', 'file': 'cvk-master-ha-log.tar.gz',
+             'cmd': ssh_command(cvk_master_ip, f'find /var/log/cvk-ha/ -type f -mtime -{g_last_ndays} | tar -czf - -T -')})
 
-    # Iterate through each key in the commands dictionary
-    for key in commands:
-        # Append each command in common_commands to the list associated with the key
-        for command in common_commands:
-            commands[key].append(command)
+    return {collector['id']: collector for collector in collectors}
 
-        # commands[key] = list(set(commands[key]))
+def resolve_plan(collectors, log_types):
+    # 收集所有日志，选项all，把所有其他的选项都包含进来
+    # 每个收集项只会出现一次，顺序与注册表一致
+    selected = set(log_types)
+    for log_type in selected:
+        if log_type != 'all' and not any(log_type in c['groups'] for c in collectors.values()):
+            print_with_color(f"No collectors for {log_type} logs. Skipping.", "red")
 
-    # 收集所有日志，选项0，把所有其他的选项都包含进来
-    # Populate the 'all' key with all commands from other keys
-    for key in commands:
-        if key != 'all':
-            commands['all'].extend(commands[key])
+    plan = []
+    for cid, collector in collectors.items():
+        if 'all' in selected or 'common' in collector['groups'] or selected & set(collector['groups']):
+            plan.append(cid)
 
-    collected_logs = {}
+    return plan
 
-    for log_type in log_types:
-        print_with_color(f"Collecting {log_type} logs...", "green")
-        print(commands[log_type])
+def collector_inputs(collector):
+    if 'source' in collector:
+        return [collector['source']]
+    return collector.get('paths') or collector.get('inputs', [])
 
-        if log_type in commands:
-            for idx, command in enumerate(commands[log_type]):
+def scan_log_files(path, recent):
+    # 用 os.scandir 递归遍历日志目录, 代替 find <path> -type f -mtime -<g_last_ndays>
+    # 返回 (路径, 大小, 修改时间), 最新的文件排在前面
+    cutoff = time.time() - float(g_last_ndays) * 86400 if recent else None
+    if g_since is not None:
+        # 时间窗口开始之前就不再修改的文件不可能包含窗口内的日志
+        cutoff = g_since if cutoff is None else max(cutoff, g_since)
+    selected = []
+    pending = [path]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
                 try:
-                    log_name = f"{command[-2]}"
-                    print("Executing: ")
-                    print_with_color(command[0:-2], "green")
-                    output = subprocess.check_output(command[0:-2])
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if cutoff is None or st.st_mtime >= cutoff:
+                    selected.append((entry.path, st.st_size, st.st_mtime))
+
+    selected.sort(key=lambda f: f[2], reverse=True)
+    return selected
+
+def allocate_log_budget(collectors, plan):
+    # 收集开始前扫描所有日志目录, 所有组件的文件统一按修改时间从新到旧分配预算, 结果与线程调度顺序无关
+    # 单个组件超出预算后该组件更旧的文件不再打包, 全局预算用完后所有更旧的文件都不再打包
+    # 返回 {收集项 id: [(日志目录, 文件路径, 修改时间, 估算大小, 超出的预算或 None)]}, 每个列表从新到旧
+    candidates = []
+    allocation = {}
+    for cid in plan:
+        collector = collectors[cid]
+        if 'paths' not in collector:
+            continue
+        allocation[cid] = []
+        for path in collector['paths']:
+            for file_path, _, file_mtime in scan_log_files(path, collector.get('recent')):
+                try:
+                    size = estimate_slice_size(file_path, collector.get('timed'), is_incremental(collector))
+                except OSError:
+                    continue
+                candidates.append((file_mtime, cid, path, file_path, size))
+
+    # 修改时间相同的文件按收集项和路径排序, 保证每次分配的结果一致
+    candidates.sort(key=lambda c: (-c[0], c[1], c[3]))
+    component_used = {}
+    component_exhausted = set()
+    total_used = 0
+    total_exhausted = False
+    for file_mtime, cid, path, file_path, size in candidates:
+        reason = None
+        if total_exhausted:
+            reason = 'total budget'
+        elif cid in component_exhausted:
+            reason = 'component budget'
+        elif g_component_budget and component_used.get(cid, 0) + size > g_component_budget:
+            component_exhausted.add(cid)
+            reason = 'component budget'
+        elif g_total_budget and total_used + size > g_total_budget:
+            total_exhausted = True
+            reason = 'total budget'
+        else:
+            component_used[cid] = component_used.get(cid, 0) + size
+            total_used += size
+        allocation[cid].append((path, file_path, file_mtime, size, reason))
+
+    return allocation
+
+def estimate_slice_size(path, timed, incremental):
+    # 与 open_log_file 选择的范围一致: 时间窗口和增量模式下只计算实际要打包的字节数
+    # 时间窗口内的 .gz 文件要解压过滤后才知道大小, 按压缩后的大小估算
+    with open(path, 'rb') as src:
+        st = os.fstat(src.fileno())
+        start = g_incremental.start_offset(path, src, st) if incremental else 0
+        if path.endswith('.gz'):
+            return 0 if start else st.st_size
+        end = st.st_size
+        if timed and time_window_enabled():
+            slice_start, end = time_slice_range(src, st.st_size, st.st_mtime)
+            start = max(start, slice_start)
+        return max(0, end - start)
+
+def estimate_input_size(collector):
+    total = 0
+    for path in collector_inputs(collector):
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+            continue
+        size = sum(f[1] for f in scan_log_files(path, collector.get('recent')))
+        total += min(size, g_component_budget) if g_component_budget else size
+    return total
+
+def print_plan(collectors, plan):
+    print_with_color(banner_top, "cyan")
+    print_with_color(f"Collector Plan ({len(plan)} collectors):", "cyan")
+    total = 0
+    for cid in plan:
+        collector = collectors[cid]
+        if collector_inputs(collector):
+            size = estimate_input_size(collector)
+            total += size
+            size_text = f"{size:>14} bytes"
+        else:
+            size_text = f"{'-':>14}"
+        print(f"{cid:<28} {collector['dir'] + '/' + collector['file']:<40} {size_text}")
+        print_with_color(f"    {collector.get('cmd') or collector.get('source') or collector.get('paths') or collector['facts'].__name__}", "green")
+    print_with_color(f"Estimated input size: {total} bytes", "cyan")
+    print_with_color(banner_btm, "cyan")
+
+class CollectorStats:
+    # 单个收集项的资源消耗: 读取的输入字节数、加入打包文件的字节数(压缩前)、子进程的 CPU 时间
+    # 以及 --throttle 模式下因限速和退避等待的时间
+    # 压缩后的字节数由刷新压缩器的线程写出, 无法归属到收集项, 只统计整个打包文件的总数
+    # wait4 返回的子进程峰值内存包含 fork 时继承的父进程内存, 不能反映子进程本身, 不统计
+    def __init__(self, collector_id):
+        self.collector_id = collector_id
+        self.bytes_read = 0
+        self.bytes_added = 0
+        self.child_cpu_time = 0.0
+        self.throttled_time = 0.0
+
+# 每个收集线程当前正在执行的收集项的 CollectorStats
+g_stats = threading.local()
+
+def current_stats():
+    return getattr(g_stats, 'current', None)
+
+# 正在运行的子进程的进程组, 收集被中断时一起结束
+g_children = set()
+g_children_lock = threading.Lock()
+# 收集被中断(Ctrl-C)后设置, 收集线程在下一次读取时停止
+g_abort = threading.Event()
+
+class CollectionAborted(BaseException):
+    # 不是 Exception 的子类, 收集线程中处理读取错误的 except Exception 不会把它当成普通的读取错误
+    pass
+
+def count_bytes_read(size):
+    if g_abort.is_set():
+        raise CollectionAborted("collection was interrupted")
+    stats = current_stats()
+    if stats is not None:
+        stats.bytes_read += size
+    if g_throttle is not None:
+        g_throttle.consume(size)
+
+class Throttle:
+    # --throttle 模式下限制读取带宽, 主机负载或 PSI 压力超过阈值时逐步退避
+    # 所有收集线程共用一个令牌桶, read_limit 是整个进程的读取带宽上限
+    check_interval = 1.0
+    min_backoff = 0.1
+    max_backoff = 5.0
+
+    def __init__(self, read_limit, max_load, max_pressure):
+        self.read_limit = read_limit
+        self.max_load = max_load
+        self.max_pressure = max_pressure
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.last_refill = time.monotonic()
+        self.next_check = 0.0
+        self.resume_at = 0.0
+        self.backoff = 0.0
+        self.throttled_time = 0.0
+        self.backoff_count = 0
+
+    def consume(self, size):
+        delay = 0.0
+        with self.lock:
+            now = time.monotonic()
+            if self.read_limit:
+                # 令牌不够时记为欠账, 后面的读取要等欠账还清
+                self.tokens = min(self.read_limit, self.tokens + (now - self.last_refill) * self.read_limit)
+                self.last_refill = now
+                self.tokens -= size
+                if self.tokens < 0:
+                    delay = -self.tokens / self.read_limit
+
+            if now >= self.next_check:
+                # 负载持续超过阈值时暂停时间逐次加倍, 每次暂停后至少运行 check_interval 再检查
+                overloaded = self.check_load()
+                if overloaded:
+                    self.backoff = min(self.max_backoff, max(self.min_backoff, self.backoff * 2))
+                    self.backoff_count += 1
+                    self.resume_at = now + self.backoff
+                    print_with_color(f"Host overloaded ({overloaded}), backing off {self.backoff:.1f}s", "yellow")
+                else:
+                    self.backoff = 0.0
+                self.next_check = max(now, self.resume_at) + self.check_interval
+            # 暂停期间所有收集线程都等到 resume_at
+            delay += max(0.0, self.resume_at - now)
+
+        if delay:
+            # 收集被中断时不再等待
+            g_abort.wait(delay)
+            with self.lock:
+                self.throttled_time += delay
+            stats = current_stats()
+            if stats is not None:
+                stats.throttled_time += delay
 
-                    # 检查是否存在错误信息
-                    # for msg in common_err_msgs:
-                    #     if msg in output.decode():
-                    #         print_with_color(f"Running {output} failed", "red")
-                    #         print_with_color(output, "red")
+    def check_load(self):
+        # 返回超过阈值的原因, 没有超过时返回 None
+        if self.max_load:
+            try:
+                with open('/proc/loadavg') as loadavg:
+                    load = float(loadavg.read().split()[0]) / (os.cpu_count() or 1)
+                if load > self.max_load:
+                    return f"load {load:.2f} per cpu"
+            except (OSError, ValueError):
+                pass
+        if self.max_pressure:
+            for resource_name in ('cpu', 'io'):
+                try:
+                    with open(f'/proc/pressure/{resource_name}') as pressure:
+                        # some avg10=1.23 avg60=0.50 avg300=0.10 total=12345
+                        fields = dict(item.split('=') for item in pressure.readline().split()[1:])
+                    avg10 = float(fields['avg10'])
+                except (OSError, ValueError, KeyError):
+                    continue
+                if avg10 > self.max_pressure:
+                    return f"{resource_name} pressure {avg10:.1f}%"
+        return None
 
-                    # 检查是否存在config, log, info目录，如果不存在，则创建
+    def summary(self):
+        return {
+            'read_limit': self.read_limit,
+            'max_load': self.max_load,
+            'max_pressure': self.max_pressure,
+            'throttled_time': round(self.throttled_time, 3),
+            'backoffs': self.backoff_count,
+        }
 
-                    if not os.path.exists(os.path.join(temp_dir, command[-1])):
-                        print_with_color(f"Creating {os.path.join(temp_dir, command[-1])} {command[-1]} directory", "green")
-                        os.makedirs(os.path.join(temp_dir, command[-1]))
+def lower_priority(nice):
+    # 降低本进程的 CPU 和 IO 优先级, 之后创建的收集线程和子进程都会继承
+    # 需要在创建线程池之前调用
+    try:
+        os.nice(nice)
+    except OSError as e:
+        print_with_color(f"Failed to set nice {nice}: {e}", "red")
+    ionice = shutil.which('ionice')
+    if ionice is None:
+        print_with_color("ionice not found, IO priority is not changed", "red")
+        return
+    # 使用 best-effort 的最低优先级, idle 类在磁盘一直繁忙的主机上可能永远得不到调度
+    result = subprocess.run([ionice, '-c', '2', '-n', '7', '-p', str(os.getpid())],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode:
+        print_with_color(f"Failed to set IO priority: {result.stderr.decode(errors='replace').strip()}", "red")
 
-                    log_path = os.path.join(os.path.join(temp_dir,command[-1]), log_name)
-                    print_with_color(f"Writing {log_name} logs to {log_path}", "yellow")
+def run_commands_and_collect_logs(bundle, log_types):
+    collectors = build_collectors()
+    plan = resolve_plan(collectors, log_types)
+    timings = []
+    if bundle.completed:
+        print_with_color(f"Resuming {bundle.root_name}, skipping completed collectors: {', '.join(bundle.completed)}", "green")
+        bundle.manifest['resumed'] = sorted(bundle.completed)
+        plan = [cid for cid in plan if cid not in bundle.completed]
+        # 中断前完成的收集项的耗时、错误统计和增量偏移
+        for record in bundle.completed.values():
+            timings.append(dict(record['timing'], resumed=True))
+            if bundle.scanner is not None and 'signatures' in record:
+                bundle.scanner.restore(record['signatures'])
+            if g_incremental is not None:
+                g_incremental.restore(record.get('incremental', {}))
+    print_with_color(f"Collecting {', '.join(log_types)} logs: {len(plan)} collectors", "green")
 
-                    with open(log_path, 'wb') as log_file:
-                        log_file.write(output)
+    collected_logs = {}
+    start = time.monotonic()
+    log_files = allocate_log_budget(collectors, plan)
 
-                    collected_logs[log_name] = log_path
-                except subprocess.CalledProcessError as e:
+    executor = ThreadPoolExecutor(max_workers=g_max_workers)
+    futures = []
+    try:
+        for cid in plan:
+            futures.append(executor.submit(run_collector, collectors[cid], bundle, log_files.get(cid)))
+        for future in as_completed(futures):
+            log_name, result, elapsed, size, stats = future.result()
+            collected_logs[log_name] = result
+            timing = collector_timing(log_name, elapsed, size, not result.startswith("Error:"), stats)
+            timings.append(timing)
+            if timing['ok']:
+                record = {'timing': timing}
+                if bundle.scanner is not None and bundle.scanner.collected is not None:
+                    record['signatures'] = bundle.scanner.pop_collector_counts(stats.collector_id)
+                if g_incremental is not None:
+                    record['incremental'] = g_incremental.collector_files(stats.collector_id)
+                bundle.finish_collector(stats.collector_id, record)
+    except BaseException:
+        stop_collection(executor, futures, bundle)
+        raise
+    executor.shutdown()
 
-                    print_with_color(f"Collecting {log_name} logs failed", "red")
-                    collected_logs[log_name] = f"Error: {e}"
+    write_collector_summary(bundle, timings)
+    write_timings(bundle, timings, time.monotonic() - start)
+    if g_throttle is not None:
+        bundle.manifest['throttle'] = g_throttle.summary()
+    if bundle.scanner is not None:
+        write_signature_summary(bundle)
+    bundle.add_manifest()
 
     return collected_logs
 
-# def create_tarball(temp_dir, tar_path):
-#     with tarfile.open(tar_path, 'w') as tar:
-#         for root, _, files in os.walk(temp_dir):
-#             for file in files:
-#                 file_path = os.path.join(root, file)
-#                 arcname = os.path.relpath(file_path, temp_dir)
-#                 tar.add(file_path, arcname=arcname)
-
-# def create_tarball(temp_dir, tar_path):
-#     # Extract the base name of the tarball (without extension)
-#     tar_base_name = os.path.splitext(os.path.basename(tar_path))[0]
-#     
-#     # Create a top-level directory name
-#     top_level_dir = os.path.join(temp_dir, tar_base_name)
-#     
-#     # Ensure the top-level directory exists
-#     os.makedirs(top_level_dir, exist_ok=True)
-#     
-#     # Move all files from temp_dir to the top-level directory
-#     for root, _, files in os.walk(temp_dir):
-#         for file in files:
-#             file_path = os.path.join(root, file)
-#             new_file_path = os.path.join(top_level_dir, os.path.relpath(file_path, temp_dir))
-#             os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
-#             os.rename(file_path, new_file_path)
-#     
-#     # Create the tarball
-#     with tarfile.open(tar_path, 'w') as tar:
-#         for root, _, files in os.walk(top_level_dir):
-#             for file in files:
-#                 file_path = os.path.join(root, file)
-#                 arcname = os.path.relpath(file_path, top_level_dir)
-#                 tar.add(file_path, arcname=arcname)
-#     
-#     # Clean up: Remove the top-level directory
-#     for root, _, files in os.walk(top_level_dir, topdown=False):
-#         for file in files:
-#             os.remove(os.path.join(root, file))
-#         os.rmdir(root)
-
-
-def create_tarball(temp_dir, tar_path):
-    # Extract the base name of the tarball (without extension)
-    tar_base_name = os.path.splitext(os.path.basename(tar_path))[0]
-    
-    # Create the tarball
-    with tarfile.open(tar_path, 'w') as tar:
-        for root, _, files in os.walk(temp_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Create the relative path with the top-level directory
-                arcname = os.path.join(tar_base_name, os.path.relpath(file_path, temp_dir))
-                tar.add(file_path, arcname=arcname)
+# 日志行开头的时间戳:
+# libvirt: 2024-10-18 10:00:00.123+0000: 1234: info : ...
+# qemu:    2024-10-18T10:00:00.123456Z qemu-kvm: ...
+# syslog:  Oct 18 10:00:00 host kernel: ...
+iso_time_re = re.compile(rb'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(Z|[+-]\d{2}:?\d{2})?')
+syslog_time_re = re.compile(rb'^([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) ')
+syslog_months = {m.encode(): i for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
+# 可能带时间戳的行首, 在 mmap 上直接查找, 跳过任意多的续行
+timed_line_re = re.compile(rb'^(?:\d{4}-\d{2}-\d{2}[T ]\d{2}:|[A-Z][a-z]{2} +\d{1,2} \d{2}:)', re.M)
+
+# --since/--until 的时间, 秒和时区可以省略
+time_arg_re = re.compile(rb'(\d{4})-(\d{2})-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)? *(Z|[+-]\d{2}:?\d{2})?')
+
+def iso_timestamp(when, tz):
+    # 没有时区时按本地时间
+    if tz is None:
+        return when.timestamp()
+    if tz == b'Z':
+        return when.replace(tzinfo=timezone.utc).timestamp()
+    tz = tz.replace(b':', b'')
+    offset = timedelta(hours=int(tz[1:3]), minutes=int(tz[3:5]))
+    if tz[:1] == b'-':
+        offset = -offset
+    return when.replace(tzinfo=timezone(offset)).timestamp()
+
+def parse_time_arg(text):
+    # --since/--until 支持 "2024-10-18 10:00[:00]" (本地时间) 和带时区的 ISO 8601 格式
+    # 不用 datetime.fromisoformat: 集群节点上的 python3 可能低于 3.7, 3.11 之前也不支持 Z
+    m = time_arg_re.fullmatch(text.strip().encode())
+    if not m:
+        raise ValueError(f"expected 'YYYY-MM-DD[ HH:MM[:SS]][timezone]', got {text!r}")
+    year, month, day, hour, minute, second, tz = m.groups()
+    when = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+    return iso_timestamp(when, tz)
+
+def make_line_time_parser(ref_mtime):
+    # syslog 时间戳没有年份, 以文件修改时间所在的年份为准, 跨年的行归到上一年
+    ref_year = datetime.fromtimestamp(ref_mtime).year
+
+    def parse(line):
+        m = iso_time_re.match(line)
+        if m:
+            year, month, day, hour, minute, second, tz = m.groups()
+            try:
+                when = datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+            except ValueError:
+                return None
+            return iso_timestamp(when, tz)
+
+        m = syslog_time_re.match(line)
+        if m and m.group(1) in syslog_months:
+            month = syslog_months[m.group(1)]
+            day, hour, minute, second = (int(g) for g in m.groups()[1:])
+            try:
+                when = datetime(ref_year, month, day, hour, minute, second).timestamp()
+                if when > ref_mtime + 86400:
+                    when = datetime(ref_year - 1, month, day, hour, minute, second).timestamp()
+            except ValueError:
+                return None
+            return when
+
+        return None
+
+    return parse
+
+def first_timed_line(mm, pos, parse):
+    # 从 pos 所在行的下一行开始(pos 为 0 时从第一行开始), 找到第一个带时间戳的行
+    size = len(mm)
+    if pos > 0:
+        pos = mm.find(b'\n', pos - 1)
+        if pos < 0:
+            return None, None
+        pos += 1
+
+    # 连续的续行可能超过任意固定的行数, 不能只向后探测有限行, 否则二分查找的判断不再单调
+    while pos < size:
+        m = timed_line_re.search(mm, pos)
+        if m is None:
+            break
+        pos = m.start()
+        end = mm.find(b'\n', pos)
+        if end < 0:
+            end = size
+        when = parse(mm[pos:min(end, pos + 64)])
+        if when is not None:
+            return pos, when
+        pos = end + 1
+
+    return None, None
+
+def find_time_offset(mm, target, parse, after):
+    # 在按时间排序的日志中二分查找第一行 时间 >= target (after 为 True 时 > target) 的偏移
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        _, when = first_timed_line(mm, mid, parse)
+        if when is None or (when > target if after else when >= target):
+            hi = mid
+        else:
+            lo = mid + 1
+
+    offset, _ = first_timed_line(mm, lo, parse)
+    return len(mm) if offset is None else offset
+
+def time_slice_range(fileobj, size, mtime):
+    # 返回时间窗口在文件中的 [start, end) 字节范围, 文件中找不到时间戳时返回整个文件
+    if size == 0:
+        return 0, 0
+
+    parse = make_line_time_parser(mtime)
+    with mmap.mmap(fileobj.fileno(), size, access=mmap.ACCESS_READ) as mm:
+        if first_timed_line(mm, 0, parse)[0] is None:
+            return 0, size
+        start = 0 if g_since is None else find_time_offset(mm, g_since, parse, after=False)
+        end = size if g_until is None else find_time_offset(mm, g_until, parse, after=True)
+    return start, max(start, end)
+
+class LogSlice:
+    # 日志文件中要打包的部分, fileobj 已经定位到要打包的第一个字节, 共 size 字节
+    # offset 是下次增量收集开始的位置, fingerprint 是 offset 之前的内容的指纹
+    # filtered 表示内容是从 .gz 文件中解压过滤出来的
+    def __init__(self, path, fileobj, st, start=0, end=None, offset=None, filtered=False, fingerprint=None):
+        self.path = path
+        self.fileobj = fileobj
+        self.st = st
+        self.start = start
+        self.end = st.st_size if end is None else end
+        self.size = self.end - self.start
+        self.offset = self.end if offset is None else offset
+        self.filtered = filtered
+        self.fingerprint = fingerprint
+        self.partial = filtered or self.start > 0 or self.end < st.st_size
+
+class UnreadableLogError(Exception):
+    # 日志文件无法解压过滤, 只跳过这个文件, 不影响同一收集项的其他文件
+    pass
+
+def skip_unreadable_log(bundle, collector, path, error):
+    print_with_color(f"{collector['id']}: skipping {path}: {error}", "red")
+    entry = {'collector': collector['id'], 'path': path, 'reason': f"unreadable: {error}"}
+    try:
+        st = os.stat(path)
+        entry.update(size=st.st_size, mtime=st.st_mtime)
+    except OSError:
+        pass
+    bundle.note('skipped', entry)
+
+@contextmanager
+def open_log_file(path, timed=False, incremental=False):
+    # 时间窗口模式下普通文件通过 mmap 二分查找窗口的偏移, 只读取窗口内的字节; .gz 轮转文件只能顺序解压过滤
+    # 增量模式下从上次打包结束的位置开始
+    with open(path, 'rb') as src:
+        st = os.fstat(src.fileno())
+        start = g_incremental.start_offset(path, src, st) if incremental else 0
+        window = timed and time_window_enabled()
+
+        if path.endswith('.gz'):
+            fingerprint = offset_fingerprint(src, st.st_size) if incremental else None
+            src.seek(0)
+            # 压缩的轮转文件不会再追加内容, 打包过一次后不再重复打包
+            if start:
+                yield LogSlice(path, src, st, st.st_size, fingerprint=fingerprint)
+            elif not window:
+                yield LogSlice(path, src, st, fingerprint=fingerprint)
+            else:
+                with gzip.GzipFile(fileobj=src) as gz, tempfile.SpooledTemporaryFile(max_size=g_spool_size, dir=g_output_dir) as spool:
+                    try:
+                        size = filter_time_window(gz, spool, make_line_time_parser(st.st_mtime))
+                    except (OSError, EOFError, zlib.error) as e:
+                        # logrotate 压缩到一半或者损坏的 .gz 文件
+                        raise UnreadableLogError(str(e)) from e
+                    spool.seek(0)
+                    yield LogSlice(path, spool, st, 0, size, offset=st.st_size, filtered=True, fingerprint=fingerprint)
+            return
+
+        end = st.st_size
+        if window:
+            slice_start, end = time_slice_range(src, st.st_size, st.st_mtime)
+            start = max(start, slice_start)
+        end = max(start, end)
+        fingerprint = offset_fingerprint(src, end) if incremental else None
+        src.seek(start)
+        yield LogSlice(path, src, st, start, end, fingerprint=fingerprint)
+
+def filter_time_window(src, out_file, parse):
+    # 顺序读取时只保留时间窗口内的行, 没有时间戳的续行跟随上一行
+    keep = False
+    timed = 0
+    for line in src:
+        when = parse(line[:64])
+        if when is not None:
+            timed += 1
+            keep = (g_since is None or when >= g_since) and (g_until is None or when <= g_until)
+        if keep:
+            out_file.write(line)
+
+    if not timed:
+        src.seek(0)
+        shutil.copyfileobj(src, out_file, g_chunk_size)
+
+    return out_file.tell()
+
+def time_window_enabled():
+    return g_since is not None or g_until is not None
+
+def is_incremental(collector):
+    # 只有日志支持增量收集, 配置文件和命令输出每次都完整打包
+    return g_incremental is not None and collector['dir'] == 'log' and 'cmd' not in collector
+
+def rotated_siblings(path, incremental):
+    # messages-20241018, messages.1, libvirtd.log.1.gz 之类的轮转文件
+    # 时间窗口模式下打包可能包含窗口内日志的文件, 增量模式下打包上次收集之后轮转的文件
+    siblings = []
+    for sibling in glob.glob(glob.escape(path) + '[-.]*'):
+        try:
+            st = os.stat(sibling)
+        except OSError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        if (time_window_enabled() and st.st_mtime >= (g_since or 0)) or \
+                (incremental and g_incremental.rotated_since_last_run(st)):
+            siblings.append((sibling, st.st_mtime))
+    siblings.sort(key=lambda f: f[1])
+    return [sibling for sibling, _ in siblings]
+
+def add_log_slice(bundle, arcname, log_slice, incremental):
+    size = bundle.add_fileobj(arcname, log_slice.fileobj, log_slice.size, log_slice.st.st_mtime)
+    if log_slice.partial:
+        bundle.note('ranges', {'path': log_slice.path, 'arcname': arcname, 'start': log_slice.start,
+                               'end': log_slice.end, 'filtered': log_slice.filtered})
+    if incremental:
+        g_incremental.record(log_slice.path, log_slice.st, log_slice.offset, log_slice.fingerprint)
+    return size
+
+def add_source_file(collector, arcname, bundle):
+    # 时间窗口或增量模式下, 当前文件和轮转文件都只打包需要的部分
+    incremental = is_incremental(collector)
+    timed = collector.get('timed')
+    size = 0
+    with open_log_file(collector['source'], timed, incremental) as log_slice:
+        if log_slice.size or not log_slice.partial:
+            size += add_log_slice(bundle, arcname, log_slice, incremental)
+
+    if not (incremental or (timed and time_window_enabled())):
+        return size
+
+    for sibling in rotated_siblings(collector['source'], incremental):
+        name = os.path.basename(sibling)
+        try:
+            with open_log_file(sibling, timed, incremental) as log_slice:
+                if log_slice.filtered:
+                    name = name[:-3]
+                if log_slice.size:
+                    size += add_log_slice(bundle, f"{collector['dir']}/{name}", log_slice, incremental)
+        except UnreadableLogError as e:
+            skip_unreadable_log(bundle, collector, sibling, e)
+    return size
+
+def offset_fingerprint(fileobj, offset):
+    # offset 之前最多 g_fingerprint_size 字节的 sha256
+    size = min(offset, g_fingerprint_size)
+    fileobj.seek(offset - size)
+    return hashlib.sha256(fileobj.read(size)).hexdigest()
+
+def rotation_origin(path):
+    # copytruncate 轮转复制出的文件对应的原文件: libvirtd.log.1 -> libvirtd.log, messages-20241018 -> messages
+    origin = re.sub(r'(\.\d+|-\d{8})$', '', path)
+    return origin if origin != path else None
+
+class IncrementalState:
+    # 增量收集的状态文件, 记录每个已打包文件的 inode、大小、修改时间、已打包到的偏移和偏移之前内容的指纹
+    def __init__(self, path, bundle_id):
+        self.path = path
+        self.bundle_id = bundle_id
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+        try:
+            with open(path) as state_file:
+                data = json.load(state_file)
+        except FileNotFoundError:
+            data = {}
+        except ValueError as e:
+            print_with_color(f"Ignoring broken state file {path}: {e}", "red")
+            data = {}
+
+        self.previous_bundle = data.get('bundle')
+        self.previous_time = data.get('time')
+        self.files = data.get('files', {})
+        self.by_inode = {(entry['dev'], entry['inode']): entry for entry in self.files.values()}
+        # 上次收集结束时的记录, 不随本次收集更新
+        self.previous_files = dict(self.files)
+        # 每个收集项本次记录的文件, 分卷打包续传时用来恢复已完成收集项的偏移
+        self.collected = {}
+
+    def start_offset(self, path, src, st):
+        # 按 inode 查找, 文件被轮转改名(messages -> messages-20241018)后仍然能从上次的位置继续
+        # copytruncate 轮转时原文件 inode 不变但被截断后重新写入, 复制出的 libvirtd.log.1 是新的 inode,
+        # 所以还要比较偏移之前内容的指纹: 原文件不再匹配, 从头打包; 复制出的文件匹配原文件的记录, 从上次的位置继续
+        with self.lock:
+            entry = self.by_inode.get((st.st_dev, st.st_ino))
+            if entry is None and rotation_origin(path) is not None:
+                entry = self.previous_files.get(rotation_origin(path))
+        if entry is None or st.st_size < entry['offset']:
+            # 新文件或者被截断的文件需要完整打包
+            return 0
+        if offset_fingerprint(src, entry['offset']) != entry.get('fingerprint'):
+            return 0
+        return entry['offset']
+
+    def rotated_since_last_run(self, st):
+        if self.previous_time is None:
+            return False
+        with self.lock:
+            known = (st.st_dev, st.st_ino) in self.by_inode
+        return known or st.st_mtime >= self.previous_time
+
+    def record(self, path, st, offset, fingerprint):
+        entry = {'dev': st.st_dev, 'inode': st.st_ino, 'size': st.st_size, 'mtime': st.st_mtime,
+                 'offset': offset, 'fingerprint': fingerprint, 'bundle': self.bundle_id}
+        stats = current_stats()
+        with self.lock:
+            self.files[path] = entry
+            self.by_inode[(st.st_dev, st.st_ino)] = entry
+            if stats is not None:
+                self.collected.setdefault(stats.collector_id, {})[path] = entry
+
+    def collector_files(self, collector_id):
+        with self.lock:
+            return dict(self.collected.get(collector_id, {}))
+
+    def restore(self, files):
+        # 续传时恢复中断前已完成的收集项记录的偏移, 只影响保存的状态, 不影响本次的起始偏移
+        with self.lock:
+            self.files.update(files)
+
+    def save(self):
+        # 已经被删除的文件不再保留
+        files = {path: entry for path, entry in self.files.items() if os.path.exists(path)}
+        data = {'bundle': self.bundle_id, 'time': self.time, 'files': files}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(data, state_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+def run_collector(collector, bundle, log_files=None):
+    log_name = collector['file']
+    arcname = f"{collector['dir']}/{log_name}"
+
+    stats = g_stats.current = CollectorStats(collector['id'])
+    start = time.monotonic()
+    size = 0
+    try:
+        # 输出直接追加到最终的打包文件中，不经过临时目录和中间 tar.gz
+        if 'source' in collector and (is_incremental(collector) or collector.get('timed') and time_window_enabled()):
+            print_with_color(f"Slicing {collector['source']} as {arcname}", "yellow")
+            size = add_source_file(collector, arcname, bundle)
+        elif 'source' in collector:
+            print_with_color(f"Adding {collector['source']} as {arcname}", "yellow")
+            size = bundle.add_file(arcname, collector['source'])
+        elif 'paths' in collector:
+            size = add_log_dirs(collector, arcname, bundle, log_files)
+            print_with_color(f"Added {collector['paths']} as {arcname}", "yellow")
+        elif 'facts' in collector:
+            text, data = collector['facts']()
+            size = bundle.add_bytes(arcname, text.encode())
+            size += bundle.add_bytes(f"{arcname}.json", json.dumps(data, indent=2).encode())
+            print_with_color(f"Writing {log_name} facts to {arcname}", "yellow")
+        else:
+            print_with_color(f"Executing: {collector['cmd']}", "green")
+            size = bundle.add_command_output(arcname, collector['cmd'], g_collector_timeout)
+            print_with_color(f"Writing {log_name} logs to {arcname}", "yellow")
+
+        result = arcname
+    except subprocess.CalledProcessError as e:
+        print_with_color(f"Collecting {log_name} logs failed", "red")
+        result = f"Error: {e}"
+    except subprocess.TimeoutExpired as e:
+        print_with_color(f"Collecting {log_name} logs timed out after {e.timeout}s", "red")
+        result = f"Error: {e}"
+    except OSError as e:
+        print_with_color(f"Collecting {log_name} logs failed: {e}", "red")
+        result = f"Error: {e}"
+    except Exception as e:
+        # 其他意外的错误只算这个收集项失败, 不中断整个收集
+        print_with_color(f"Collecting {log_name} logs failed unexpectedly: {e!r}", "red")
+        traceback.print_exc()
+        result = f"Error: {e!r}"
+    finally:
+        g_stats.current = None
+
+    elapsed = time.monotonic() - start
+
+    return log_name, result, elapsed, size, stats
+
+def add_log_dirs(collector, arcname, bundle, log_files):
+    # 按 allocate_log_budget 分配的结果从最新的文件开始打包, 超出预算的文件只记录到 manifest 中
+    incremental = is_incremental(collector)
+    size = 0
+    exhausted = None
+    for path, file_path, file_mtime, estimated_size, reason in log_files:
+        if reason is not None:
+            exhausted = exhausted or reason
+            bundle.note('skipped', {'collector': collector['id'], 'path': file_path,
+                                    'size': estimated_size, 'mtime': file_mtime, 'reason': reason})
+            continue
+
+        file_arcname = f"{arcname}/{os.path.relpath(file_path, path)}"
+        try:
+            with open_log_file(file_path, collector.get('timed'), incremental) as log_slice:
+                if log_slice.size == 0 and log_slice.partial:
+                    continue
+                if log_slice.filtered:
+                    file_arcname = file_arcname[:-3]
+                size += add_log_slice(bundle, file_arcname, log_slice, incremental)
+        except FileNotFoundError:
+            # 日志在收集过程中被轮转删除
+            continue
+        except UnreadableLogError as e:
+            skip_unreadable_log(bundle, collector, file_path, e)
+
+    if exhausted is not None:
+        print_with_color(f"{collector['id']}: {exhausted} exceeded, older files are listed in manifest.json", "red")
+
+    return size
+
+def run_command_to_file(args, out_file, timeout, check=True):
+    # 按块读取子进程的标准输出并写入 out_file，内存占用与输出大小无关
+    # sh -c 启动的 find/tar/ssh 等子进程在超时后也要一起结束，所以放到独立的进程组里
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, start_new_session=True)
+    register_child(proc)
+    timed_out = threading.Event()
+
+    def kill_on_timeout():
+        timed_out.set()
+        kill_process_group(proc.pid)
+
+    timer = threading.Timer(timeout, kill_on_timeout)
+    timer.start()
+    try:
+        size = 0
+        while True:
+            chunk = proc.stdout.read(g_chunk_size)
+            if not chunk:
+                break
+            out_file.write(chunk)
+            size += len(chunk)
+        wait_child(proc)
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+        unregister_child(proc)
+
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+    if check and proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, args)
+
+    return size
+
+def register_child(proc):
+    with g_children_lock:
+        g_children.add(proc.pid)
+
+def kill_process_group(pid):
+    # 进程组可能在超时或中断的同时已经全部退出
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def unregister_child(proc):
+    with g_children_lock:
+        g_children.discard(proc.pid)
+
+def kill_children():
+    # 子进程在独立的进程组里, 收不到终端的 Ctrl-C, 需要逐个结束
+    with g_children_lock:
+        pids = list(g_children)
+    for pid in pids:
+        kill_process_group(pid)
+
+def stop_collection(executor, futures, bundle):
+    # Ctrl-C 或其他错误时不再等待剩下的收集项: 打包文件标记为中断, 取消排队的收集项,
+    # 结束正在运行的子进程, 正在读取文件的收集线程在下一次读取时停止, 然后等待这些线程退出
+    g_abort.set()
+    bundle.aborted = True
+    # shutdown 的 cancel_futures 参数需要 3.9, 逐个取消, 已经开始的收集项不受影响
+    for future in futures:
+        future.cancel()
+    kill_children()
+    executor.shutdown(wait=True)
+
+def wait_child(proc):
+    # 用 wait4 回收子进程, 同时得到子进程的 CPU 时间
+    # 集群模式在各节点的 python3 上运行, 不用 3.9 才有的 os.waitstatus_to_exitcode, 与 subprocess 一样被信号结束时为负的信号值
+    _, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+
+    stats = current_stats()
+    if stats is not None:
+        stats.child_cpu_time += usage.ru_utime + usage.ru_stime
+
+class _CountingWriter:
+    # 统计写入打包文件的字节数(压缩后), 指定 digest 时同时计算写入内容的校验和
+    def __init__(self, raw, digest=None):
+        self.raw = raw
+        self.digest = digest
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        if self.digest is not None:
+            self.digest.update(data)
+        return self.raw.write(data)
+
+    def flush(self):
+        self.raw.flush()
+
+def open_compressed(raw, codec, level):
+    if codec == 'gz':
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=level)
+    if codec == 'xz':
+        return lzma.LZMAFile(raw, 'wb', preset=level)
+    if codec == 'bz2':
+        return bz2.BZ2File(raw, 'wb', compresslevel=level)
+    if codec == 'zst':
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+    return None
+
+class _FixedSizeReader:
+    # tar 头部中的大小在写入前就已确定, 文件在读取过程中变短时用 \0 补齐, 变长时截断
+    # 读取出错时(如远程节点的 tar 流中断)同样用 \0 补齐, 保证后面追加的文件不会错位, 错误记录在 error 中
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+        self.error = None
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = b''
+        if self.error is None:
+            try:
+                data = self.fileobj.read(size)
+            except Exception as e:
+                self.error = e
+        count_bytes_read(len(data))
+        if len(data) < size:
+            data += b'\0' * (size - len(data))
+        self.remaining -= len(data)
+        return data
+
+def new_signature_counts():
+    return {'patterns': {}, 'files': {}, 'hours': {}, 'samples': {}}
+
+def merge_signature_counts(target, counts, max_samples):
+    # 错误信息的统计: 每种错误信息的总行数、每个文件和每小时的行数、最多 max_samples 行样例
+    target['files'].update(counts['files'])
+    for msg, count in counts['patterns'].items():
+        target['patterns'][msg] = target['patterns'].get(msg, 0) + count
+    for hour, hour_counts in counts['hours'].items():
+        merged = target['hours'].setdefault(hour, {})
+        for msg, count in hour_counts.items():
+            merged[msg] = merged.get(msg, 0) + count
+    for msg, samples in counts['samples'].items():
+        merged = target['samples'].setdefault(msg, [])
+        merged.extend(samples[:max_samples - len(merged)])
+
+class SignatureScanner:
+    # 在打包的同时扫描日志中的错误信息, 所有错误信息合并成一个正则, 每块数据只扫描一遍
+    # 统计每种错误信息在每个文件、每个小时出现的行数, 并保留前 max_samples 行作为样例
+    def __init__(self, messages, max_samples):
+        # 较长的错误信息放在前面, 同一位置优先匹配 failed 而不是 fail
+        # 先把数据转成小写再匹配, 不用 IGNORECASE 和命名分组, 否则正则无法使用字面量前缀加速
+        self.messages = {msg.lower().encode(): msg for msg in messages}
+        self.regex = re.compile(b'|'.join(re.escape(msg) for msg in sorted(self.messages, key=len, reverse=True)))
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.counts = new_signature_counts()
+        # 分卷打包时每个收集项合并后的统计, 收集项完成时交给分卷的进度记录, 续传时恢复; None 表示不需要
+        self.collected = None
+
+    def wants(self, arcname):
+        # 只扫描本机 log 目录下的文本日志, 压缩文件和集群模式下合并的节点日志不扫描
+        return arcname.startswith('log/') and not arcname.endswith(('.gz', '.xz', '.bz2', '.zst', '.tar'))
+
+    def scan(self, state, buf):
+        line_start = -1
+        seen = set()
+        for m in self.regex.finditer(buf.lower()):
+            start = buf.rfind(b'\n', 0, m.start()) + 1
+            if start != line_start:
+                line_start = start
+                seen = set()
+            msg = self.messages[m.group()]
+            if msg in seen:
+                continue
+            seen.add(msg)
+
+            state.counts[msg] = state.counts.get(msg, 0) + 1
+            hour = state.hour_of(buf[start:start + 64])
+            hour_counts = state.hours.setdefault(hour, {})
+            hour_counts[msg] = hour_counts.get(msg, 0) + 1
+
+            samples = state.samples.setdefault(msg, [])
+            if len(samples) < self.max_samples:
+                end = buf.find(b'\n', m.end())
+                line = buf[start:end if end >= 0 else len(buf)][:512]
+                samples.append({'file': state.arcname, 'line': line.decode(errors='replace')})
+
+    def merge(self, state):
+        if not state.counts:
+            return
+        counts = {'patterns': state.counts, 'files': {state.arcname: state.counts},
+                  'hours': state.hours, 'samples': state.samples}
+        stats = current_stats()
+        with self.lock:
+            merge_signature_counts(self.counts, counts, self.max_samples)
+            if self.collected is not None and stats is not None:
+                collected = self.collected.setdefault(stats.collector_id, new_signature_counts())
+                merge_signature_counts(collected, counts, self.max_samples)
+
+    def track_collectors(self):
+        with self.lock:
+            if self.collected is None:
+                self.collected = {}
+
+    def pop_collector_counts(self, collector_id):
+        # 收集项完成后它的统计不会再变化, 交出去后不再保留
+        with self.lock:
+            if self.collected is None:
+                return None
+            return self.collected.pop(collector_id, new_signature_counts())
+
+    def restore(self, counts):
+        # 续传时合并中断前已完成的收集项的统计
+        with self.lock:
+            merge_signature_counts(self.counts, counts, self.max_samples)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'patterns': dict(sorted(self.counts['patterns'].items(), key=lambda t: t[1], reverse=True)),
+                'files': self.counts['files'],
+                'hours': dict(sorted(self.counts['hours'].items())),
+                'samples': self.counts['samples'],
+            }
+
+class _ScanningReader:
+    # 读取数据时顺便交给 SignatureScanner 扫描, 不完整的最后一行留到下一块
+    def __init__(self, reader, scanner, arcname, mtime):
+        self.reader = reader
+        self.scanner = scanner
+        self.arcname = arcname
+        self.parse = make_line_time_parser(time.time() if mtime is None else mtime)
+        self.carry = b''
+        # 正在跳过超长行剩余的部分
+        self.skip_line = False
+        self.counts = {}
+        self.hours = {}
+        self.samples = {}
+        self.hour_cache = {}
+
+    def hour_of(self, line):
+        # 时间戳前 13 个字节相同的行在同一个小时内, 不用每行都解析
+        key = line[:13]
+        hour = self.hour_cache.get(key)
+        if hour is None:
+            when = self.parse(line)
+            hour = datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:00') if when is not None else 'unknown'
+            if len(self.hour_cache) > 4096:
+                self.hour_cache.clear()
+            self.hour_cache[key] = hour
+        return hour
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        buf = data
+        if self.skip_line:
+            cut = data.find(b'\n') + 1
+            if not cut:
+                return data
+            buf = data[cut:]
+            self.skip_line = False
+
+        buf = self.carry + buf
+        cut = buf.rfind(b'\n') + 1
+        if cut:
+            self.scanner.scan(self, buf[:cut])
+        self.carry = buf[cut:]
+        if len(self.carry) > g_max_scan_line:
+            # 没有换行的数据(二进制内容或补齐的 \0)不能一直累积, 只扫描行首部分, 其余跳到下一个换行
+            self.scanner.scan(self, self.carry[:g_max_scan_line])
+            self.carry = b''
+            self.skip_line = True
+        return data
+
+    def finish(self):
+        if self.carry:
+            self.scanner.scan(self, self.carry)
+            self.carry = b''
+        self.scanner.merge(self)
+
+def hash_fileobj(fileobj, size, reader=None):
+    # 分块计算 sha256, 计算完成后回到原来的位置, 后面再从同一位置打包
+    # reader 是包装 fileobj 的 _ScanningReader 时同时扫描错误信息
+    pos = fileobj.tell()
+    reader = reader or fileobj
+    digest = hashlib.sha256()
+    remaining = size
+    while remaining:
+        chunk = reader.read(min(g_chunk_size, remaining))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+        count_bytes_read(len(chunk))
+    fileobj.seek(pos)
+    return digest.hexdigest()
+
+class ContentIndex:
+    # 已打包内容的 sha256 索引, 内容相同的文件只打包一次, 重复的文件在 manifest 中引用第一次打包的位置
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = 0
+
+        try:
+            with open(path) as index_file:
+                self.entries = json.load(index_file).get('entries', {})
+        except FileNotFoundError:
+            self.entries = {}
+        except ValueError as e:
+            print_with_color(f"Ignoring broken content index {path}: {e}", "red")
+            self.entries = {}
+
+    def claim(self, digest, size, bundle_id, arcname):
+        # 内容已经打包过时返回之前的记录, 否则登记为本次打包的内容
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None and entry['size'] == size:
+                self.saved += size
+                return entry
+            self.entries[digest] = {'size': size, 'bundle': bundle_id, 'arcname': arcname, 'time': time.time()}
+            return None
+
+    def release(self, digest):
+        with self.lock:
+            self.entries.pop(digest, None)
+
+    def save(self):
+        # 超过 g_dedup_keep_days 天的记录不再引用, 对应的打包文件可能已经被清理
+        cutoff = time.time() - g_dedup_keep_days * 86400
+        entries = {digest: entry for digest, entry in self.entries.items() if entry['time'] >= cutoff}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as index_file:
+            json.dump({'entries': entries}, index_file)
+        os.replace(tmp_path, self.path)
+
+class BundleWriter:
+    # 所有收集结果直接写入一个压缩的 tar 包, 每个文件只写一次
+    # tarfile 不是线程安全的, 多个收集线程通过 lock 串行追加
+    def __init__(self, path, root_name, codec='gz', level=None, scanner=None, content_index=None):
+        self.path = path
+        self.root_name = root_name
+        self.scanner = scanner
+        self.content_index = content_index
+        self.lock = threading.Lock()
+        # 打包文件的说明, 收集结束时写入 manifest.json
+        self.manifest = {'bundle': root_name, 'created': datetime.now().isoformat(timespec='seconds'), 'skipped': []}
+        # 之前中断的收集中已经完成的收集项, 只有分卷打包可以续传
+        self.completed = {}
+        # 写入失败或者被中断后不能再追加文件
+        self.aborted = False
+        if level is None:
+            level = compress_codecs[codec][1]
+        if codec == 'zst' and zstandard is None:
+            raise RuntimeError("zstd compression requires the zstandard module")
+        self.codec = codec
+        self.level = level
+        self._open(path)
+
+    def _open(self, path, digest=None):
+        if path == '-':
+            self.raw = sys.__stdout__.buffer
+        else:
+            self.raw = open(path, 'wb')
+        self.counting = _CountingWriter(self.raw, digest)
+        self.compressed = open_compressed(self.counting, self.codec, self.level)
+        self.tar = tarfile.open(fileobj=self.compressed or self.counting, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def _tarinfo(self, arcname, size, mtime=None):
+        info = tarfile.TarInfo(f"{self.root_name}/{arcname}")
+        info.size = size
+        info.mtime = time.time() if mtime is None else mtime
+        info.mode = 0o644
+        return info
+
+    def add_file(self, arcname, path):
+        with open(path, 'rb') as src:
+            st = os.fstat(src.fileno())
+            return self.add_fileobj(arcname, src, st.st_size, st.st_mtime)
+
+    def add_fileobj(self, arcname, fileobj, size, mtime=None, dedup=True):
+        # 需要去重的文件在计算 sha256 时一起扫描错误信息, 只引用之前打包内容的文件也计入错误统计
+        scan = self.scanner is not None and self.scanner.wants(arcname)
+        scanning = None
+        digest = None
+        if dedup and size and self.content_index is not None:
+            if scan:
+                scanning = _ScanningReader(fileobj, self.scanner, arcname, mtime)
+            digest = hash_fileobj(fileobj, size, scanning)
+            entry = self.content_index.claim(digest, size, self.root_name, arcname)
+            if entry is not None:
+                if scanning is not None:
+                    scanning.finish()
+                self.note('references', {'arcname': arcname, 'sha256': digest, 'size': size,
+                                         'bundle': entry['bundle'], 'target': entry['arcname']})
+                return 0
+
+        fixed_reader = reader = _FixedSizeReader(fileobj, size)
+        if scan and scanning is None:
+            scanning = reader = _ScanningReader(reader, self.scanner, arcname, mtime)
+
+        try:
+            self._addfile(self._tarinfo(arcname, size, mtime), reader)
+            stats = current_stats()
+            if stats is not None:
+                stats.bytes_added += size
+            if fixed_reader.error is not None:
+                # 文件已经用 \0 补齐到头部中的大小, 打包文件仍然完整, 只有这个收集项失败
+                self.note('truncated', {'arcname': arcname, 'size': size, 'error': str(fixed_reader.error)})
+                raise OSError(f"reading {arcname} failed: {fixed_reader.error}")
+        except BaseException:
+            if digest is not None:
+                self.content_index.release(digest)
+            raise
+        finally:
+            if scanning is not None:
+                scanning.finish()
+        return size
+
+    def _addfile(self, info, reader):
+        with self.lock:
+            # 中断后或者写入失败后打包文件已经不完整, 不能再追加
+            if self.aborted:
+                raise OSError(f"bundle {self.root_name} was aborted")
+            try:
+                self._write_member(info, reader)
+            except BaseException:
+                # tar 头部已经写入而数据没有写完, 后面追加的文件都会错位
+                self.aborted = True
+                raise
+
+    def _write_member(self, info, reader):
+        self.tar.addfile(info, reader)
+
+    def bytes_written(self):
+        # 到目前为止写出的压缩后字节数, 不包括还缓存在压缩器中的数据
+        return self.counting.size
+
+    def add_bytes(self, arcname, data):
+        return self.add_fileobj(arcname, io.BytesIO(data), len(data), dedup=False)
+
+    def add_command_output(self, arcname, args, timeout):
+        # tar 头部需要预先知道大小, 命令输出先写入 SpooledTemporaryFile, 较小的输出不会落盘
+        with tempfile.SpooledTemporaryFile(max_size=g_spool_size, dir=g_output_dir) as spool:
+            size = run_command_to_file(args, spool, timeout)
+            spool.seek(0)
+            return self.add_fileobj(arcname, spool, size)
+
+    def note(self, section, entry):
+        with self.lock:
+            self.manifest.setdefault(section, []).append(entry)
+
+    def add_manifest(self):
+        if self.content_index is not None:
+            self.manifest['dedup'] = {'index': self.content_index.path, 'saved_bytes': self.content_index.saved}
+        return self.add_bytes('manifest.json', json.dumps(self.manifest, indent=2).encode())
+
+    def finish_collector(self, collector_id, record=None):
+        # 单个打包文件在关闭前都不完整, 不需要记录收集进度
+        pass
+
+    def _close_stream(self):
+        self.tar.close()
+        if self.compressed is not None:
+            self.compressed.close()
+        if self.raw is sys.__stdout__.buffer:
+            self.raw.flush()
+        else:
+            self.raw.close()
+
+    def close(self):
+        self._close_stream()
+
+    def abort(self):
+        # 打包文件可能停在某个文件中间, 关闭后删除, 关闭失败(如磁盘已满)时也要删除
+        # 写到标准输出时只能关闭, 无法删除
+        with self.lock:
+            self.aborted = True
+            try:
+                self._close_stream()
+            except Exception as e:
+                print_with_color(f"Closing {self.path} failed: {e}", "red")
+            finally:
+                if self.raw is not sys.__stdout__.buffer:
+                    os.remove(self.path)
+
+class PartedBundleWriter(BundleWriter):
+    # --part-size-mb 模式: 打包结果按大小拆成编号的分卷, 每个分卷都是完整的 tar 包, 文件不会跨分卷
+    # <bundle>.manifest.json 记录已关闭分卷的大小和 sha256 以及已完成的收集项, 每个收集项完成和每个分卷关闭时更新
+    # 收集项写过的分卷都关闭后才算完成, 中断后用同一项目名重新运行时跳过已完成的收集项
+    # 已完成的收集项同时记录写入的文件、manifest 中的条目以及 finish_collector 传入的耗时等信息, 续传时恢复
+    # 未完成的收集项写入已关闭分卷的文件记录在 partial 中, 续传时重新收集, 旧的副本记录到 manifest 的 stale 中
+    def __init__(self, base_path, root_name, codec='gz', level=None, scanner=None, content_index=None,
+                 part_size=0, options=None, state=None):
+        state = state or {}
+        self.base_path = str(base_path)
+        self.ext = compress_codecs[codec][0]
+        self.part_size = part_size
+        self.manifest_path = f"{self.base_path}.manifest.json"
+        self.parts = list(state.get('parts', []))
+        # 当前分卷中写过文件的收集项, 已结束但当前分卷还没关闭的收集项和它们的记录
+        self.owners = set()
+        self.pending = {}
+        # 每个未完成的收集项写入的文件 {分卷: [文件名]} 和 manifest 条目 {section: [条目]}
+        self.collector_files = {}
+        self.collector_notes = {}
+        self.part_files = 0
+        # 本次运行关闭的分卷的总大小
+        self.closed_size = 0
+        super().__init__(self.part_path(len(self.parts) + 1), root_name, codec, level, scanner, content_index)
+        if scanner is not None:
+            scanner.track_collectors()
+        self.completed = dict(state.get('collectors', {}))
+        self.stale = list(state.get('stale', []))
+        for record in self.completed.values():
+            for section, entries in record['notes'].items():
+                self.manifest.setdefault(section, []).extend(entries)
+        if self.stale:
+            self.manifest['stale'] = self.stale
+        self.progress = {
+            'bundle': root_name,
+            'created': state.get('created', self.manifest['created']),
+            'codec': codec,
+            'part_size': part_size,
+            'options': options,
+            'parts': self.parts,
+            'collectors': self.completed,
+            'partial': {},
+            'stale': self.stale,
+            'complete': False,
+        }
+        self.write_progress()
+
+    def part_path(self, number):
+        return f"{self.base_path}.part{number:03d}{self.ext}"
+
+    def _open(self, path, digest=None):
+        self.part_digest = hashlib.sha256()
+        super()._open(path, self.part_digest)
+
+    def _write_member(self, info, reader):
+        if self.part_files and self.counting.size >= self.part_size:
+            self._close_part()
+            self.path = self.part_path(len(self.parts) + 1)
+            self._open(self.path)
+            self.write_progress()
+        self.tar.addfile(info, reader)
+        self.part_files += 1
+        stats = current_stats()
+        if stats is not None:
+            self.owners.add(stats.collector_id)
+            files = self.collector_files.setdefault(stats.collector_id, {})
+            files.setdefault(os.path.basename(self.path), []).append(info.name.split('/', 1)[1])
+
+    def note(self, section, entry):
+        super().note(section, entry)
+        stats = current_stats()
+        if stats is not None:
+            with self.lock:
+                self.collector_notes.setdefault(stats.collector_id, {}).setdefault(section, []).append(entry)
+
+    def _complete(self, collector_id, record):
+        self.completed[collector_id] = dict(record, files=self.collector_files.pop(collector_id, {}),
+                                            notes=self.collector_notes.pop(collector_id, {}))
+
+    def _close_part(self):
+        self._close_stream()
+        self.parts.append({'file': os.path.basename(self.path), 'size': self.counting.size,
+                           'sha256': self.part_digest.hexdigest()})
+        print_with_color(f"Closed {self.path} ({self.counting.size} bytes)", "green")
+        self.closed_size += self.counting.size
+        for collector_id, record in self.pending.items():
+            self._complete(collector_id, record)
+        self.pending.clear()
+        self.owners.clear()
+        self.part_files = 0
+
+    def bytes_written(self):
+        return self.closed_size + self.counting.size
+
+    def finish_collector(self, collector_id, record=None):
+        with self.lock:
+            if self.aborted:
+                return
+            if collector_id in self.owners:
+                self.pending[collector_id] = record or {}
+            else:
+                self._complete(collector_id, record or {})
+            self.write_progress()
+
+    def write_progress(self):
+        # 未完成的收集项只记录已关闭分卷中的文件, 当前分卷在中断后会被删除
+        closed = {part['file'] for part in self.parts}
+        self.progress['partial'] = {
+            collector_id: {part: names for part, names in files.items() if part in closed}
+            for collector_id, files in self.collector_files.items() if closed & set(files)
+        }
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, 'w') as progress_file:
+            # 每个收集项完成时都要重写, 不缩进
+            json.dump(self.progress, progress_file)
+        os.replace(tmp_path, self.manifest_path)
+
+    def close(self):
+        with self.lock:
+            self._close_part()
+            self.progress['complete'] = True
+            self.write_progress()
+
+    def abort(self):
+        # 当前分卷可能停在某个文件中间, 直接删除, 已关闭的分卷和 manifest 保留用于续传
+        super().abort()
+        with self.lock:
+            self.write_progress()
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as src:
+        while True:
+            chunk = src.read(g_chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def find_resumable_bundle(bundle_dir, prefix, options):
+    # 同一项目最近一次未完成的分卷打包, 返回 (分卷路径前缀, manifest)
+    # 分卷缺失或 sha256 不一致时从该分卷开始丢弃, 写在这些分卷中的收集项重新收集
+    # 重新收集的收集项留在保留分卷中的文件是旧的副本, 记录到 stale 中
+    manifests = glob.glob(os.path.join(glob.escape(str(bundle_dir)), f"{glob.escape(prefix)}-*.manifest.json"))
+    if not manifests:
+        return None
+    manifest_path = max(manifests, key=os.path.getmtime)
+    try:
+        with open(manifest_path) as manifest_file:
+            state = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        print_with_color(f"Ignoring unreadable {manifest_path}: {e}", "red")
+        return None
+    if state.get('complete'):
+        return None
+    if state.get('options') != options:
+        print_with_color(f"Not resuming {manifest_path}: collection options differ", "yellow")
+        return None
+
+    valid = []
+    for part in state.get('parts', []):
+        part_path = os.path.join(os.path.dirname(manifest_path), part['file'])
+        try:
+            ok = os.path.getsize(part_path) == part['size'] and file_sha256(part_path) == part['sha256']
+        except OSError:
+            ok = False
+        if not ok:
+            print_with_color(f"Part {part_path} is missing or corrupted, collecting its contents again", "red")
+            break
+        valid.append(part)
+    kept = {part['file'] for part in valid}
+    collectors = {}
+    stale = [entry for entry in state.get('stale', []) if entry['part'] in kept]
+    partial = dict(state.get('partial', {}))
+    for cid, record in state.get('collectors', {}).items():
+        if set(record['files']) <= kept:
+            collectors[cid] = record
+        else:
+            partial[cid] = record['files']
+    for cid, files in partial.items():
+        stale += [{'collector': cid, 'part': part, 'arcnames': names} for part, names in files.items() if part in kept]
+    state['parts'] = valid
+    state['collectors'] = collectors
+    state['stale'] = stale
+    return manifest_path[:-len('.manifest.json')], state
+
+def write_signature_summary(bundle):
+    summary = bundle.scanner.summary()
+
+    print_with_color(banner_top, "cyan")
+    print_with_color("Error Signatures:", "cyan")
+    for msg, count in summary['patterns'].items():
+        print_with_color(f"{msg:<32} {count:>10} lines", "red")
+    for msg, samples in summary['samples'].items():
+        for sample in samples[:3]:
+            print(f"[{msg}] {sample['file']}: {sample['line']}")
+    print_with_color(banner_btm, "cyan")
+
+    bundle.add_bytes('summary.json', json.dumps(summary, indent=2, ensure_ascii=False).encode())
+
+def collector_timing(log_name, elapsed, size, ok, stats):
+    return {
+        'id': stats.collector_id,
+        'file': log_name,
+        'ok': ok,
+        'wall_time': round(elapsed, 6),
+        'size': size,
+        'bytes_read': stats.bytes_read,
+        'bytes_added': stats.bytes_added,
+        'child_cpu_time': round(stats.child_cpu_time, 6),
+        'throttled_time': round(stats.throttled_time, 6),
+    }
+
+def write_timings(bundle, timings, elapsed):
+    # 每个收集项的资源消耗, 写入打包文件中的 timings.json
+    # 续传时中断前完成的收集项带有 resumed 标记, wall_time 等是中断前那次运行的数据
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    data = {
+        'wall_time': round(elapsed, 6),
+        'workers': g_max_workers,
+        'cpu_time': round(self_usage.ru_utime + self_usage.ru_stime, 6),
+        'peak_rss_kb': self_usage.ru_maxrss,
+        'children_cpu_time': round(children_usage.ru_utime + children_usage.ru_stime, 6),
+        'bundle_bytes_written': bundle.bytes_written(),
+        'collectors': timings,
+    }
+    if g_throttle is not None:
+        data['throttle'] = g_throttle.summary()
+    bundle.add_bytes('timings.json', json.dumps(data, indent=2).encode())
+
+def write_collector_summary(bundle, timings):
+    timings.sort(key=lambda t: t['wall_time'], reverse=True)
+
+    lines = [banner_top, "Collector Summary:"]
+    for t in timings:
+        status = 'resumed' if t.get('resumed') else 'ok' if t['ok'] else 'failed'
+        lines.append(f"{t['file']:<32} {status:<7} {t['wall_time']:8.2f}s {t['size']:>14} bytes")
+    if g_throttle is not None:
+        lines.append(f"Throttled for {g_throttle.throttled_time:.2f}s ({g_throttle.backoff_count} load backoffs)")
+    lines.append(banner_btm)
+
+    for line in lines:
+        print_with_color(line, "cyan")
+
+    bundle.add_bytes('info/collector-summary', ("\n".join(lines) + "\n").encode())
+
+def get_cluster_nodes():
+    # nodes.json 中所有节点的管理地址, master 节点排在第一个
+    nodes = json.load(open(host_path('/var/lib/cvk-ha/nodes.json')))
+    ips = []
+
+    def walk(value):
+        if isinstance(value, dict):
+            ip = value.get('ManageIp')
+            if isinstance(ip, str) and ip and ip not in ips:
+                ips.append(ip)
+            for child in value.values():
+                walk(child)
+        elif isinstance(value, list):
+            for child in value:
+                walk(child)
+
+    walk(nodes.get('MasterNode', {}))
+    walk(nodes)
+    return ips
+
+def ssh_command(ip, *remote_args):
+    # 同一个节点的所有 ssh 命令复用一个 ControlMaster 连接
+    return [*g_ssh_command,
+            '-o', 'BatchMode=yes',
+            '-o', 'ControlMaster=auto',
+            '-o', f'ControlPath={g_ssh_control_dir}/%r@%h:%p',
+            '-o', 'ControlPersist=60',
+            f'root@{ip}', *remote_args]
+
+def remote_collector_args(args, project_name):
+    # 远程节点使用相同的收集参数, 结果以 tar 流的形式写到标准输出
+    remote_args = ['--cluster-node', '--output', '-', '--compress', 'gz', '--level', '1',
+                   '--days', str(g_last_ndays), '--project', project_name,
+                   '--jobs', str(g_max_workers), '--timeout', str(g_collector_timeout),
+                   '--component-budget-mb', str(args.component_budget_mb),
+                   '--total-budget-mb', str(args.total_budget_mb),
+                   '--state-dir', args.state_dir]
+    if g_root:
+        remote_args += ['--root', g_root]
+    for option in ('types', 'since', 'until'):
+        if getattr(args, option):
+            remote_args += [f'--{option}', getattr(args, option)]
+    if args.incremental:
+        remote_args.append('--incremental')
+    if args.dedup:
+        remote_args.append('--dedup')
+    if args.throttle:
+        remote_args += ['--throttle', '--read-limit-mb', str(args.read_limit_mb),
+                        '--max-load', str(args.max_load), '--max-pressure', str(args.max_pressure)]
+    return remote_args
+
+def collect_node(ip, bundle, remote_args):
+    # 把本脚本通过 ssh 标准输入发给节点上的 python3 执行, 边接收边把 tar 流合并到 nodes/<ip>/ 下
+    start = time.monotonic()
+    size = 0
+    arc_prefix = f"nodes/{ip}"
+    # 分卷打包按节点记录收集进度
+    g_stats.current = CollectorStats(ip)
+    print_with_color(f"Collecting logs from {ip}...", "green")
+
+    try:
+        # 先建立 ControlMaster 连接, 后面的命令都复用这个连接
+        subprocess.run(ssh_command(ip, 'true'), check=True, timeout=g_collector_timeout,
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+        remote_command = ' '.join(shlex.quote(arg) for arg in ['python3', '-', *remote_args])
+        with open(os.path.abspath(__file__), 'rb') as script:
+            proc = subprocess.Popen(ssh_command(ip, remote_command), stdin=script,
+                                    stdout=subprocess.PIPE, start_new_session=True)
+        register_child(proc)
+        timed_out = threading.Event()
+
+        def kill_on_timeout():
+            timed_out.set()
+            kill_process_group(proc.pid)
+
+        timer = threading.Timer(g_node_timeout, kill_on_timeout)
+        timer.start()
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode='r|*') as remote_tar:
+                for member in remote_tar:
+                    if not member.isfile():
+                        continue
+                    # 去掉远程打包文件的顶层目录
+                    name = member.name.split('/', 1)[-1]
+                    size += bundle.add_fileobj(f"{arc_prefix}/{name}", remote_tar.extractfile(member),
+                                               member.size, member.mtime, dedup=False)
+            proc.wait()
+        finally:
+            timer.cancel()
+            proc.stdout.close()
+            if proc.poll() is None:
+                kill_process_group(proc.pid)
+                proc.wait()
+            unregister_child(proc)
+
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(remote_command, g_node_timeout)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, remote_command)
+
+        result = 'ok'
+    except (subprocess.SubprocessError, tarfile.TarError, OSError) as e:
+        print_with_color(f"Collecting logs from {ip} failed: {e}", "red")
+        result = f"Error: {e}"
+    except Exception as e:
+        print_with_color(f"Collecting logs from {ip} failed unexpectedly: {e!r}", "red")
+        traceback.print_exc()
+        result = f"Error: {e!r}"
+    finally:
+        g_stats.current = None
+        subprocess.run(ssh_command(ip, '-O', 'exit'), stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return ip, result, time.monotonic() - start, size
+
+def run_cluster_collection(bundle, nodes, remote_args):
+    timings = []
+    if bundle.completed:
+        print_with_color(f"Resuming {bundle.root_name}, skipping completed nodes: {', '.join(bundle.completed)}", "green")
+        bundle.manifest['resumed'] = sorted(bundle.completed)
+        nodes = [ip for ip in nodes if ip not in bundle.completed]
+        for record in bundle.completed.values():
+            node = record['node']
+            timings.append((node['node'], node['elapsed'], node['size'], 'resumed'))
+            bundle.note('nodes', dict(node, resumed=True))
+    print_with_color(f"Collecting logs from {len(nodes)} nodes: {', '.join(nodes)}", "green")
+
+    executor = ThreadPoolExecutor(max_workers=g_cluster_workers)
+    futures = []
+    try:
+        for ip in nodes:
+            futures.append(executor.submit(collect_node, ip, bundle, remote_args))
+        for future in as_completed(futures):
+            ip, result, elapsed, size = future.result()
+            timings.append((ip, elapsed, size, 'ok' if result == 'ok' else 'failed'))
+            node = {'node': ip, 'result': result, 'elapsed': round(elapsed, 3), 'size': size}
+            if result == 'ok':
+                bundle.finish_collector(ip, {'node': node})
+            bundle.note('nodes', node)
+    except BaseException:
+        stop_collection(executor, futures, bundle)
+        raise
+    executor.shutdown()
+
+    timings.sort(key=lambda t: t[1], reverse=True)
+    lines = [banner_top, "Cluster Summary:"]
+    for ip, elapsed, size, status in timings:
+        lines.append(f"{ip:<32} {status:<7} {elapsed:8.2f}s {size:>14} bytes")
+    lines.append(banner_btm)
+
+    for line in lines:
+        print_with_color(line, "cyan")
+
+    bundle.add_bytes('info/cluster-summary', ("\n".join(lines) + "\n").encode())
+    bundle.add_manifest()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="H3C CVK log collector")
+    parser.add_argument('-j', '--jobs', type=int, default=g_max_workers,
+                        help=f"number of collectors to run concurrently (default {g_max_workers})")
+    parser.add_argument('--timeout', type=int, default=g_collector_timeout,
+                        help=f"per collector timeout in seconds (default {g_collector_timeout})")
+    parser.add_argument('--types', help="comma separated log types to collect: all, network, compute (default all)")
+    parser.add_argument('--component-budget-mb', type=int, default=g_component_budget // (1024 * 1024),
+                        help="max MB collected from each log directory, 0 for unlimited (default %(default)s)")
+    parser.add_argument('--total-budget-mb', type=int, default=g_total_budget // (1024 * 1024),
+                        help="max MB collected from all log directories, 0 for unlimited (default %(default)s)")
+    parser.add_argument('--since', help="only collect messages/libvirt/qemu log lines after this time, e.g. '2024-10-18 10:00'")
+    parser.add_argument('--until', help="only collect messages/libvirt/qemu log lines before this time")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only collect log bytes and rotated files added since the previous run of this project")
+    parser.add_argument('--state-dir', default=g_state_dir,
+                        help=f"directory of the incremental collection state and dedup index (default {g_state_dir})")
+    parser.add_argument('--days', type=int, help=f"collect logs modified in the last N days (default {g_last_ndays}, asked when omitted)")
+    parser.add_argument('--project', help="project name used in the bundle name (asked when omitted)")
+    parser.add_argument('-o', '--output', help="bundle path, '-' writes the bundle to stdout "
+                                               "(default <output-dir>/<project>-<host>-<time>.tar.gz)")
+    parser.add_argument('--output-dir', default=g_output_dir,
+                        help="directory of the bundle, its parts and temporary spool files (default current directory)")
+    parser.add_argument('--cluster', action='store_true',
+                        help="collect from every node in /var/lib/cvk-ha/nodes.json over ssh into one bundle")
+    parser.add_argument('--cluster-jobs', type=int, default=g_cluster_workers,
+                        help=f"number of nodes collected concurrently in cluster mode (default {g_cluster_workers})")
+    parser.add_argument('--node-timeout', type=int, default=g_node_timeout,
+                        help=f"per node timeout in seconds in cluster mode (default {g_node_timeout})")
+    parser.add_argument('--ssh', default=' '.join(g_ssh_command), help="ssh command used to reach other nodes (default ssh)")
+    parser.add_argument('--cluster-node', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--root', default=g_root, help="read logs and configs below this directory instead of / (for testing)")
+    parser.add_argument('--no-scan', action='store_true', help="do not scan collected logs for error signatures")
+    parser.add_argument('--samples', type=int, default=g_max_samples,
+                        help=f"sample lines kept per error signature in summary.json (default {g_max_samples})")
+    parser.add_argument('--dedup', action='store_true',
+                        help="store identical files once and reference files already shipped in previous bundles")
+    parser.add_argument('--compress', choices=list(compress_codecs), default='gz',
+                        help="bundle compression codec, zst requires the zstandard module (default gz)")
+    parser.add_argument('--level', type=int, help="compression level (default depends on codec)")
+    parser.add_argument('--throttle', action='store_true',
+                        help="run at low CPU/IO priority, cap read bandwidth and back off when the host is loaded")
+    parser.add_argument('--read-limit-mb', type=int, default=g_throttle_read_mb,
+                        help="read bandwidth cap in MB/s in throttled mode, 0 for unlimited (default %(default)s)")
+    parser.add_argument('--max-load', type=float, default=g_throttle_max_load,
+                        help="back off when the 1 minute load average per cpu exceeds this in throttled mode, "
+                             "0 to disable (default %(default)s)")
+    parser.add_argument('--max-pressure', type=float, default=g_throttle_max_pressure,
+                        help="back off when /proc/pressure cpu or io 'some avg10' exceeds this percentage "
+                             "in throttled mode, 0 to disable (default %(default)s)")
+    parser.add_argument('--part-size-mb', type=int, default=0,
+                        help="split the bundle into numbered parts of about this size with a <bundle>.manifest.json; "
+                             "an interrupted run is resumed by running again with the same project (default 0, one file)")
+    parser.add_argument('--no-resume', action='store_true',
+                        help="start a new bundle even if an interrupted parted bundle of this project exists")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="print the resolved collector plan and estimated input size, then exit")
+    return parser.parse_args()
 
 def get_user_input():
 
     print_with_color("How many days of logs to collect?(default 3 days)", "cyan")
     global g_last_ndays
-    g_last_ndays = input()
+    g_last_ndays = input().strip() or g_last_ndays
 
     log_type_mapping = {
         "0": "all",
@@ -300,10 +2200,60 @@ def get_user_input():
 
 
 if __name__ == "__main__":
-    log_types = get_user_input()
+    args = parse_args()
+    if args.output == '-':
+        # 打包文件写到标准输出, 其他输出(包括下面参数检查和降低优先级的提示)都改到标准错误
+        sys.stdout = sys.stderr
+    g_max_workers = max(1, args.jobs)
+    g_collector_timeout = args.timeout
+    g_component_budget = args.component_budget_mb * 1024 * 1024
+    g_total_budget = args.total_budget_mb * 1024 * 1024
+    try:
+        g_since = parse_time_arg(args.since) if args.since else None
+        g_until = parse_time_arg(args.until) if args.until else None
+    except ValueError as e:
+        print_with_color(f"Invalid --since/--until: {e}", "red")
+        raise SystemExit(1)
+
+    g_root = args.root.rstrip('/')
+    g_ssh_command = shlex.split(args.ssh)
+    g_cluster_workers = max(1, args.cluster_jobs)
+    g_node_timeout = args.node_timeout
+    g_cluster_node = args.cluster_node
+    if args.output and args.output != '-':
+        g_output_dir = os.path.dirname(os.path.abspath(args.output))
+    elif not args.output:
+        g_output_dir = args.output_dir
+    else:
+        # 打包写到标准输出时没有输出目录, 临时文件使用系统默认目录
+        g_output_dir = None
+    if args.throttle:
+        lower_priority(g_throttle_nice)
+        g_throttle = Throttle(args.read_limit_mb * 1024 * 1024, args.max_load, args.max_pressure)
+
+    if args.part_size_mb and args.output:
+        print_with_color("--part-size-mb cannot be used with --output", "red")
+        raise SystemExit(1)
+
+    if args.days is None:
+        log_types = get_user_input()
+    else:
+        g_last_ndays = args.days
+        log_types = ["all"]
+    if args.types:
+        log_types = [log_type.strip() for log_type in args.types.split(',') if log_type.strip()]
+
+    if args.dry_run:
+        collectors = build_collectors()
+        print_plan(collectors, resolve_plan(collectors, log_types))
+        raise SystemExit(0)
+
     default_project_name = 'test'
-    print_with_color(f"enter project name(default is:%s)" % default_project_name, "green")
-    project_name = input()
+    if args.project is None:
+        print_with_color(f"enter project name(default is:%s)" % default_project_name, "green")
+        project_name = input()
+    else:
+        project_name = args.project
 
     # Get the current date and time
     current_datetime = datetime.now()
@@ -313,26 +2263,82 @@ if __name__ == "__main__":
     hostname = socket.gethostname()
 
     if not project_name:
-        tar_path = "/tmp/" + project_name + '-' + hostname + '-' + current_datetime
+        tar_path = project_name + '-' + hostname + '-' + current_datetime
     else:
         tar_path = default_project_name
-        tar_path = "/tmp/" + project_name + '-' + hostname + '-' + current_datetime
+        tar_path = project_name + '-' + hostname + '-' + current_datetime
 
-    tar_path = Path(tar_path)
+    if g_output_dir is not None:
+        try:
+            os.makedirs(g_output_dir, exist_ok=True)
+        except OSError as e:
+            print_with_color(f"Cannot create output directory {g_output_dir}: {e}", "red")
+            raise SystemExit(1)
+    tar_path = Path(g_output_dir or '.') / tar_path
 
-    if os.path.isdir(tar_path):
-        print_with_color(f"Directory {tar_path.name} already exists. Delete it.", "red")
-        # Remove the directory and its contents recursively
-        shutil.rmtree(tar_path)
-    else:
-        # Create the directory
-        tar_path.mkdir(parents=True, exist_ok=True)
-        print_with_color(f"Directory '{tar_path.name}' created.", "green")
-        collected_logs = run_commands_and_collect_logs(tar_path.name, log_types)
+    # 续传时收集参数必须和中断的那次一致
+    bundle_options = {'types': sorted(log_types), 'days': str(g_last_ndays), 'since': args.since, 'until': args.until,
+                      'incremental': args.incremental, 'dedup': args.dedup, 'cluster': args.cluster,
+                      'compress': args.compress, 'root': g_root}
+    resume_state = None
+    if args.part_size_mb and not args.no_resume:
+        resumable = find_resumable_bundle(tar_path.parent, f"{project_name}-{hostname}", bundle_options)
+        if resumable is not None:
+            tar_path, resume_state = Path(resumable[0]), resumable[1]
+            print_with_color(f"Resuming interrupted bundle {tar_path.name} ({len(resume_state['parts'])} parts kept)", "green")
+
+    if args.cluster:
+        try:
+            nodes = get_cluster_nodes()
+        except Exception as e:
+            print_with_color(f"Failed to get cluster nodes: {e}", "red")
+            raise SystemExit(1)
+
+    bundle_path = args.output or Path(str(tar_path) + compress_codecs[args.compress][0])
+    try:
+        scanner = None if args.no_scan or args.cluster else SignatureScanner(common_err_msgs, args.samples)
+        content_index = None
+        if args.dedup and not args.cluster:
+            content_index = ContentIndex(os.path.join(args.state_dir, 'content-index.json'))
+        if args.part_size_mb:
+            bundle = PartedBundleWriter(tar_path, tar_path.name, args.compress, args.level, scanner, content_index,
+                                        args.part_size_mb * 1024 * 1024, bundle_options, resume_state)
+            bundle_path = bundle.manifest_path
+        else:
+            bundle = BundleWriter(bundle_path, tar_path.name, args.compress, args.level, scanner, content_index)
+    except (RuntimeError, OSError) as e:
+        print_with_color(f"{e}", "red")
+        raise SystemExit(1)
+
+    if args.incremental and not args.cluster:
+        state_path = os.path.join(args.state_dir, f"{project_name or default_project_name}-{hostname}.json")
+        g_incremental = IncrementalState(state_path, tar_path.name)
+        bundle.manifest['incremental'] = {'previous_bundle': g_incremental.previous_bundle, 'state': state_path}
+        print_with_color(f"Incremental collection since bundle {g_incremental.previous_bundle}", "green")
+    try:
+        if args.cluster:
+            run_cluster_collection(bundle, nodes, remote_collector_args(args, project_name))
+        else:
+            collected_logs = run_commands_and_collect_logs(bundle, log_types)
+        bundle.close()
+    except BaseException:
+        # 收集失败或被中断时只删除本次生成的打包文件
+        bundle.abort()
+        if isinstance(bundle, PartedBundleWriter):
+            print_with_color(f"Collecting failed, removed unfinished part {bundle.path}; closed parts are listed in "
+                             f"{bundle.manifest_path}, run again with project {project_name} to resume", "red")
+        elif bundle_path != '-':
+            print_with_color(f"Collecting failed, removed {bundle_path}", "red")
+        raise
 
-        create_tarball(tar_path.name, tar_path.name + '.tar')
-        print_with_color(f"Data saved to {tar_path}.tar", "red")
-        print_with_color(f"Cleaning up...", "yellow")
-        # 删除最近10分钟的临时日志文件，和项目相关文件
-        cleanup_recent_tar_files(tar_path.name, "/tmp", minutes=10)
+    if g_incremental is not None:
+        g_incremental.save()
+    if bundle.content_index is not None:
+        bundle.content_index.save()
+        print_with_color(f"Deduplicated {bundle.content_index.saved} bytes", "green")
 
+    if isinstance(bundle, PartedBundleWriter):
+        print_with_color(f"Data saved to {len(bundle.parts)} parts {bundle.base_path}.part*{bundle.ext}, "
+                         f"manifest {bundle_path}", "red")
+    elif bundle_path != '-':
+        print_with_color(f"Data saved to {bundle_path}", "red")
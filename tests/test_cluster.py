@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench
+
+# 包装 bench 生成的 ssh 替代脚本(同一目录下的 ssh): 发往 127.0.0.2 的输出在 200000 字节处被截断, 模拟传输中断
+ssh_stand_in = '''#!/bin/sh
+ssh="$(dirname "$0")/ssh"
+case " $* " in
+  *" root@127.0.0.2 "*) "$ssh" "$@" | head -c 200000;;
+  *) exec "$ssh" "$@";;
+esac
+'''
+
+
+class ClusterCollectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp(prefix='cvk-test-')
+        bench.generate_tree(cls.root, 4, 1)
+        with open(os.path.join(cls.root, 'var/lib/cvk-ha/nodes.json'), 'w') as nodes_file:
+            json.dump({'MasterNode': {'ManageIp': '127.0.0.1'},
+                       'Nodes': [{'ManageIp': '127.0.0.1'}, {'ManageIp': '127.0.0.2'}]}, nodes_file)
+        cls.ssh = os.path.join(cls.root, 'bin', 'test-ssh')
+        with open(cls.ssh, 'w') as ssh_file:
+            ssh_file.write(ssh_stand_in)
+        os.chmod(cls.ssh, 0o755)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def run_cluster(self, *extra_args, bin_dir=None):
+        output = os.path.join(self.root, 'cluster.tar.gz')
+        env = dict(os.environ)
+        env['PATH'] = f"{self.root}/bin:{env.get('PATH', '')}"
+        if bin_dir:
+            env['PATH'] = f"{bin_dir}:{env['PATH']}"
+        proc = subprocess.run([sys.executable, bench.main_script, '--cluster', '--root', self.root,
+                               '--days', '3', '--project', 'test', '--output', output, '--ssh', self.ssh,
+                               '--state-dir', os.path.join(self.root, 'state'), '--node-timeout', '120',
+                               *extra_args],
+                              env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=300)
+        self.assertEqual(proc.returncode, 0, proc.stdout.decode(errors='replace'))
+        return output
+
+    def read_bundle(self, output):
+        # 每个文件都能完整读出, 返回文件名列表和顶层的 manifest.json
+        names = []
+        manifest = None
+        with tarfile.open(output) as bundle:
+            for member in bundle:
+                data = bundle.extractfile(member).read()
+                self.assertEqual(len(data), member.size)
+                names.append(member.name.split('/', 1)[1])
+                if names[-1] == 'manifest.json':
+                    manifest = json.loads(data)
+        return names, manifest
+
+    def test_truncated_node_stream_keeps_bundle_valid(self):
+        # 每个文件都能完整读出, 说明截断的文件被补齐, 后面的文件没有错位
+        names, manifest = self.read_bundle(self.run_cluster())
+
+        self.assertTrue(any(name.startswith('nodes/127.0.0.1/log/') for name in names))
+        self.assertIn('info/cluster-summary', names)
+
+        results = {node['node']: node['result'] for node in manifest['nodes']}
+        self.assertEqual(results['127.0.0.1'], 'ok')
+        self.assertTrue(results['127.0.0.2'].startswith('Error:'), results)
+        # 流在文件中间中断时, 该文件被补齐并记录在 manifest 中
+        self.assertTrue(all(entry['arcname'].startswith('nodes/127.0.0.2/') for entry in manifest['truncated']))
+
+    def test_throttle_warnings_do_not_corrupt_node_stream(self):
+        # 节点上的 ionice 失败并向标准输出打印内容时, 节点的 tar 流不能被破坏
+        with tempfile.TemporaryDirectory() as bin_dir:
+            ionice = os.path.join(bin_dir, 'ionice')
+            with open(ionice, 'w') as ionice_file:
+                ionice_file.write('#!/bin/sh\necho "ionice: not supported"\nexit 1\n')
+            os.chmod(ionice, 0o755)
+            names, manifest = self.read_bundle(self.run_cluster('--throttle', bin_dir=bin_dir))
+
+        results = {node['node']: node['result'] for node in manifest['nodes']}
+        self.assertEqual(results['127.0.0.1'], 'ok')
+        self.assertIn('nodes/127.0.0.1/timings.json', names)
+
+
+if __name__ == '__main__':
+    unittest.main()
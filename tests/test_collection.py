@@ -0,0 +1,193 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench
+import main
+
+# 替代 dmesg 的脚本: 记录自己的 pid 后一直运行, 模拟卡住的收集命令
+slow_dmesg = '''#!/bin/sh
+echo $$ > "$DMESG_PID_FILE"
+exec sleep 600
+'''
+
+
+def process_alive(pid):
+    # 容器中孤儿进程可能不会被回收, 僵尸进程也算已经结束
+    try:
+        with open(f'/proc/{pid}/stat') as stat_file:
+            return stat_file.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def read_parts(paths):
+    # 按分卷顺序读出所有文件, 同名文件以后面的分卷为准
+    files = {}
+    for path in paths:
+        with tarfile.open(path) as part:
+            for member in part:
+                files[member.name.split('/', 1)[1]] = part.extractfile(member).read()
+    return files
+
+
+class CollectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.root = tempfile.mkdtemp(prefix='cvk-test-')
+        bench.generate_tree(cls.root, 16, 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp(dir=self.root)
+
+    def start_collector(self, *extra_args, bin_dir=None, env=None):
+        env = dict(os.environ, **(env or {}))
+        env['PATH'] = f"{self.root}/bin:{env.get('PATH', '')}"
+        if bin_dir:
+            env['PATH'] = f"{bin_dir}:{env['PATH']}"
+        return subprocess.Popen([sys.executable, bench.main_script, '--root', self.root, '--days', '3',
+                                 '--project', 'test', '--state-dir', os.path.join(self.out_dir, 'state'),
+                                 *extra_args],
+                                env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run_collector(self, *extra_args):
+        proc = self.start_collector(*extra_args)
+        stdout, _ = proc.communicate(timeout=300)
+        self.assertEqual(proc.returncode, 0, stdout.decode(errors='replace'))
+
+    def interrupt_collector(self, *extra_args, ready=lambda: True):
+        # dmesg 卡住且 ready() 为真后发送 Ctrl-C, 返回 dmesg 的 pid, 中断用的时间和输出
+        pid_file = os.path.join(self.out_dir, 'dmesg.pid')
+        with tempfile.TemporaryDirectory() as bin_dir:
+            with open(os.path.join(bin_dir, 'dmesg'), 'w') as dmesg_file:
+                dmesg_file.write(slow_dmesg)
+            os.chmod(os.path.join(bin_dir, 'dmesg'), 0o755)
+            proc = self.start_collector(*extra_args, bin_dir=bin_dir, env={'DMESG_PID_FILE': pid_file})
+
+            deadline = time.monotonic() + 60
+            while not os.path.exists(pid_file) or not os.path.getsize(pid_file) or not ready():
+                self.assertLess(time.monotonic(), deadline, "collector did not reach the interrupt point")
+                time.sleep(0.1)
+            with open(pid_file) as dmesg_pid:
+                dmesg = int(dmesg_pid.read())
+
+            start = time.monotonic()
+            proc.send_signal(signal.SIGINT)
+            stdout, _ = proc.communicate(timeout=30)
+        self.assertNotEqual(proc.returncode, 0)
+        return dmesg, time.monotonic() - start, stdout
+
+    def test_interrupt_stops_collection(self):
+        # Ctrl-C 后不等待卡住的命令, 结束子进程并删除不完整的打包文件
+        output = os.path.join(self.out_dir, 'test.tar.gz')
+        dmesg, elapsed, stdout = self.interrupt_collector('--output', output)
+
+        self.assertLess(elapsed, 20, stdout.decode(errors='replace'))
+        self.assertFalse(os.path.exists(output))
+        self.assertFalse(process_alive(dmesg))
+
+    def test_output_dir_is_created(self):
+        output_dir = os.path.join(self.out_dir, 'new', 'bundles')
+        self.run_collector('--output-dir', output_dir, '--types', 'common')
+        self.assertEqual(len(glob.glob(os.path.join(output_dir, 'test-*.tar.gz'))), 1)
+
+    def test_resumed_bundle_keeps_completed_collectors(self):
+        # 续传后的 summary.json 和增量状态与一次完成的收集相同, timings.json 包含中断前完成的收集项
+        full_dir = os.path.join(self.out_dir, 'full')
+        resume_dir = os.path.join(self.out_dir, 'resume')
+        self.run_collector('--output-dir', full_dir, '--incremental', '--state-dir', full_dir)
+        full = read_parts(glob.glob(os.path.join(full_dir, '*.tar.gz')))
+
+        args = ('--output-dir', resume_dir, '--part-size-mb', '1', '--incremental', '--state-dir', resume_dir)
+
+        def progress():
+            manifests = glob.glob(os.path.join(resume_dir, '*.manifest.json'))
+            if not manifests:
+                return None
+            with open(manifests[0]) as manifest_file:
+                return json.load(manifest_file)
+
+        def ready():
+            state = progress()
+            return state is not None and state['parts'] and len(state['collectors']) >= 5
+
+        self.interrupt_collector(*args, ready=ready)
+        interrupted = progress()
+        self.assertFalse(interrupted['complete'])
+        self.assertNotIn('dmesg', interrupted['collectors'])
+
+        self.run_collector(*args)
+        self.assertTrue(progress()['complete'])
+        resumed = read_parts(sorted(glob.glob(os.path.join(resume_dir, '*.part*.tar.gz'))))
+
+        manifest = json.loads(resumed['manifest.json'])
+        self.assertEqual(manifest['resumed'], sorted(interrupted['collectors']))
+        timings = {t['id']: t for t in json.loads(resumed['timings.json'])['collectors']}
+        self.assertEqual(set(timings), set(t['id'] for t in json.loads(full['timings.json'])['collectors']))
+        self.assertTrue(all(timings[cid].get('resumed') for cid in interrupted['collectors']))
+        self.assertEqual(json.loads(resumed['summary.json'])['patterns'], json.loads(full['summary.json'])['patterns'])
+
+        state_files = []
+        for state_dir in (full_dir, resume_dir):
+            with open(os.path.join(state_dir, f"test-{os.uname().nodename}.json")) as state_file:
+                state_files.append(set(json.load(state_file)['files']))
+        self.assertEqual(state_files[0], state_files[1])
+
+
+class ResumableBundleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write_part(self, name, data):
+        with open(os.path.join(self.tmp.name, name), 'wb') as part_file:
+            part_file.write(data)
+        return {'file': name, 'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+
+    def test_copies_of_recollected_collectors_are_stale(self):
+        parts = [self.write_part(f'test-host-1.part00{i}.tar.gz', b'part %d' % i) for i in (1, 2, 3)]
+        # 第 3 个分卷损坏, 写过它的 b 和写在已关闭分卷中但没有完成的 c 都要重新收集
+        with open(os.path.join(self.tmp.name, parts[2]['file']), 'wb') as part_file:
+            part_file.write(b'corrupted')
+        state = {
+            'options': {}, 'complete': False, 'parts': parts,
+            'collectors': {
+                'a': {'files': {parts[0]['file']: ['log/a']}, 'notes': {}},
+                'b': {'files': {parts[1]['file']: ['log/b1'], parts[2]['file']: ['log/b2']}, 'notes': {}},
+            },
+            'partial': {'c': {parts[0]['file']: ['log/c1'], parts[1]['file']: ['log/c2']}},
+            'stale': [{'collector': 'd', 'part': parts[2]['file'], 'arcnames': ['log/d']}],
+        }
+        with open(os.path.join(self.tmp.name, 'test-host-1.manifest.json'), 'w') as manifest_file:
+            json.dump(state, manifest_file)
+
+        base, resumed = main.find_resumable_bundle(self.tmp.name, 'test-host', {})
+        self.assertEqual(base, os.path.join(self.tmp.name, 'test-host-1'))
+        self.assertEqual(resumed['parts'], parts[:2])
+        self.assertEqual(list(resumed['collectors']), ['a'])
+        self.assertEqual(resumed['stale'], [
+            {'collector': 'c', 'part': parts[0]['file'], 'arcnames': ['log/c1']},
+            {'collector': 'c', 'part': parts[1]['file'], 'arcnames': ['log/c2']},
+            {'collector': 'b', 'part': parts[1]['file'], 'arcnames': ['log/b1']},
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
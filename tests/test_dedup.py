@@ -0,0 +1,65 @@
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class DedupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'test.log')
+        with open(self.log, 'wb') as log_file:
+            for i in range(3000):
+                log_file.write(b'2024-10-18T10:00:00.000000Z %s line %d\n' % (b'Error' if i % 3 == 0 else b'ok', i))
+        self.index = os.path.join(self.tmp.name, 'state', 'content-index.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def collect(self, name):
+        # 一次 --dedup 收集, 返回打包的文件名、manifest 和 summary.json
+        scanner = main.SignatureScanner(['error', 'failed'], 5)
+        content_index = main.ContentIndex(self.index)
+        path = os.path.join(self.tmp.name, f'{name}.tar.gz')
+        bundle = main.BundleWriter(path, name, scanner=scanner, content_index=content_index)
+        bundle.add_file('log/test.log', self.log)
+        bundle.add_manifest()
+        bundle.close()
+        content_index.save()
+
+        with tarfile.open(path) as tar:
+            names = [member.name.split('/', 1)[1] for member in tar]
+        return names, bundle.manifest, scanner.summary()
+
+    def test_second_run_references_content_and_keeps_signatures(self):
+        names, manifest, summary = self.collect('first')
+        self.assertIn('log/test.log', names)
+        self.assertNotIn('references', manifest)
+        self.assertEqual(summary['patterns'], {'error': 1000})
+
+        names, manifest, second_summary = self.collect('second')
+        self.assertNotIn('log/test.log', names)
+        self.assertEqual([(ref['arcname'], ref['bundle'], ref['target']) for ref in manifest['references']],
+                         [('log/test.log', 'first', 'log/test.log')])
+        self.assertEqual(manifest['dedup']['saved_bytes'], os.path.getsize(self.log))
+        # 只引用之前打包内容的文件仍然计入错误统计
+        self.assertEqual(second_summary, summary)
+
+    def test_changed_content_is_stored_and_scanned_once(self):
+        self.collect('first')
+        with open(self.log, 'ab') as log_file:
+            log_file.write(b'2024-10-18T10:00:01.000000Z failed again\n')
+        names, manifest, summary = self.collect('second')
+        self.assertIn('log/test.log', names)
+        self.assertNotIn('references', manifest)
+        self.assertEqual(summary['patterns'], {'error': 1000, 'failed': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
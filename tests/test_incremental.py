@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class RotationTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = main.g_incremental
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp.name, 'libvirtd.log')
+        self.state = os.path.join(self.tmp.name, 'state.json')
+        self.run = 0
+
+    def tearDown(self):
+        main.g_incremental = self.saved
+        self.tmp.cleanup()
+
+    def write(self, path, tag, count, mode='ab'):
+        data = b''.join(b'2024-10-18 10:00:00.000+0000: %s-LINE-%d\n' % (tag, i) for i in range(count))
+        with open(path, mode) as log_file:
+            log_file.write(data)
+        return data.splitlines()
+
+    def collect(self):
+        # 一次增量收集: 与 add_source_file 相同, 打包当前文件和上次收集之后轮转的文件中新的部分, 返回 {文件名: 行}
+        if main.g_incremental is not None:
+            main.g_incremental.save()
+        self.run += 1
+        main.g_incremental = main.IncrementalState(self.state, f'bundle-{self.run}')
+        collected = {}
+        for path in [self.log] + main.rotated_siblings(self.log, True):
+            with main.open_log_file(path, incremental=True) as log_slice:
+                if log_slice.size:
+                    collected[os.path.basename(path)] = log_slice.fileobj.read(log_slice.size).splitlines()
+                main.g_incremental.record(log_slice.path, log_slice.st, log_slice.offset, log_slice.fingerprint)
+        return collected
+
+    def test_append_only(self):
+        first = self.write(self.log, b'OLD', 1000)
+        self.assertEqual(self.collect(), {'libvirtd.log': first})
+        added = self.write(self.log, b'NEW', 100)
+        self.assertEqual(self.collect(), {'libvirtd.log': added})
+
+    def test_rename_rotation(self):
+        first = self.write(self.log, b'OLD', 1000)
+        self.assertEqual(self.collect(), {'libvirtd.log': first})
+        # 轮转前又写入的行只在改名后的文件中
+        tail = self.write(self.log, b'TAIL', 50)
+        os.rename(self.log, self.log + '.1')
+        new = self.write(self.log, b'NEW', 2000)
+        self.assertEqual(self.collect(), {'libvirtd.log': new, 'libvirtd.log.1': tail})
+
+    def test_copytruncate_rotation(self):
+        first = self.write(self.log, b'OLD', 1000)
+        self.assertEqual(self.collect(), {'libvirtd.log': first})
+        tail = self.write(self.log, b'TAIL', 50)
+        shutil.copyfile(self.log, self.log + '.1')
+        # 同一个 inode 被截断后写到超过上次的偏移, 新内容要完整打包, 复制出的文件只打包上次之后的部分
+        new = self.write(self.log, b'NEW', 2000, mode='wb')
+        self.assertEqual(self.collect(), {'libvirtd.log': new, 'libvirtd.log.1': tail})
+        added = self.write(self.log, b'MORE', 10)
+        self.assertEqual(self.collect(), {'libvirtd.log': added})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class LogBudgetTest(unittest.TestCase):
+    # (收集项, 文件名, 几分钟前修改, 大小)
+    files = [
+        ('ovn-log', 'ovn-1.log', 10, 400),
+        ('frr-log', 'frr-1.log', 15, 300),
+        ('ovn-log', 'ovn-2.log', 20, 400),
+        ('frr-log', 'frr-2.log', 25, 300),
+        ('ovn-log', 'ovn-3.log', 30, 400),
+        ('ovn-log', 'ovn-4.log', 35, 10),
+        ('frr-log', 'frr-3.log', 40, 300),
+        ('frr-log', 'frr-4.log', 60, 1),
+    ]
+
+    def setUp(self):
+        self.saved = (main.g_component_budget, main.g_total_budget, main.g_incremental, main.g_since, main.g_until)
+        main.g_incremental = main.g_since = main.g_until = None
+        self.tmp = tempfile.TemporaryDirectory()
+        now = time.time()
+        self.collectors = {}
+        for cid, name, minutes, size in self.files:
+            log_dir = os.path.join(self.tmp.name, cid)
+            os.makedirs(log_dir, exist_ok=True)
+            path = os.path.join(log_dir, name)
+            with open(path, 'wb') as log_file:
+                log_file.write(b'x' * size)
+            os.utime(path, (now - minutes * 60, now - minutes * 60))
+            self.collectors[cid] = {'id': cid, 'groups': ('network',), 'dir': 'log', 'file': cid.split('-')[0],
+                                    'paths': [log_dir], 'recent': True}
+
+    def tearDown(self):
+        main.g_component_budget, main.g_total_budget, main.g_incremental, main.g_since, main.g_until = self.saved
+        self.tmp.cleanup()
+
+    def allocate(self, component_budget, total_budget):
+        main.g_component_budget = component_budget
+        main.g_total_budget = total_budget
+        allocation = main.allocate_log_budget(self.collectors, ['ovn-log', 'frr-log'])
+        return {cid: [(os.path.basename(f[1]), f[3], f[4]) for f in log_files]
+                for cid, log_files in allocation.items()}
+
+    def test_unlimited(self):
+        allocation = self.allocate(0, 0)
+        self.assertEqual([name for name, _, _ in allocation['ovn-log']],
+                         ['ovn-1.log', 'ovn-2.log', 'ovn-3.log', 'ovn-4.log'])
+        self.assertTrue(all(reason is None for files in allocation.values() for _, _, reason in files))
+
+    def test_component_and_total_budgets(self):
+        # 两个组件的文件按修改时间从新到旧一起分配:
+        # ovn-3 超出组件预算后, 更小的 ovn-4 也不再打包; frr-3 超出全局预算后, 所有更旧的文件都不再打包
+        allocation = self.allocate(1000, 1500)
+        self.assertEqual(allocation, {
+            'ovn-log': [('ovn-1.log', 400, None), ('ovn-2.log', 400, None),
+                        ('ovn-3.log', 400, 'component budget'), ('ovn-4.log', 10, 'component budget')],
+            'frr-log': [('frr-1.log', 300, None), ('frr-2.log', 300, None),
+                        ('frr-3.log', 300, 'total budget'), ('frr-4.log', 1, 'total budget')],
+        })
+
+    def test_skipped_files_in_manifest(self):
+        main.g_component_budget = 1000
+        main.g_total_budget = 1500
+        allocation = main.allocate_log_budget(self.collectors, ['ovn-log', 'frr-log'])
+        path = os.path.join(self.tmp.name, 'test.tar.gz')
+        bundle = main.BundleWriter(path, 'test')
+        sizes = {cid: main.add_log_dirs(self.collectors[cid], f'log/{cid}', bundle, allocation[cid])
+                 for cid in ('ovn-log', 'frr-log')}
+        bundle.close()
+
+        self.assertEqual(sizes, {'ovn-log': 800, 'frr-log': 600})
+        with tarfile.open(path) as tar:
+            self.assertEqual(sorted(member.name for member in tar),
+                             ['test/log/frr-log/frr-1.log', 'test/log/frr-log/frr-2.log',
+                              'test/log/ovn-log/ovn-1.log', 'test/log/ovn-log/ovn-2.log'])
+        skipped = [(entry['collector'], os.path.basename(entry['path']), entry['size'], entry['reason'])
+                   for entry in bundle.manifest['skipped']]
+        self.assertEqual(skipped, [
+            ('ovn-log', 'ovn-3.log', 400, 'component budget'),
+            ('ovn-log', 'ovn-4.log', 10, 'component budget'),
+            ('frr-log', 'frr-3.log', 300, 'total budget'),
+            ('frr-log', 'frr-4.log', 1, 'total budget'),
+        ])
+        self.assertTrue(all(entry['mtime'] for entry in bundle.manifest['skipped']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import contextlib
+import io
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def compute_version_facts():
+    return '', {}
+
+
+def plain_output(func, *args):
+    # 去掉 print_with_color 的颜色代码
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = func(*args)
+    return result, re.sub(r'\033\[\d+m', '', output.getvalue())
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = main.g_root
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ovn_dir = os.path.join(self.tmp.name, 'ovn')
+        os.makedirs(self.ovn_dir)
+        for name, size in (('ovn-0.log', 1000), ('ovn-1.log', 500)):
+            with open(os.path.join(self.ovn_dir, name), 'wb') as log_file:
+                log_file.write(b'x' * size)
+        self.frr_config = os.path.join(self.tmp.name, 'bgpd.conf')
+        with open(self.frr_config, 'wb') as config_file:
+            config_file.write(b'y' * 200)
+        self.collectors = {
+            'dmesg': {'id': 'dmesg', 'groups': ('common',), 'dir': 'log', 'file': 'dmesg-log', 'cmd': ['dmesg']},
+            'ovn-log': {'id': 'ovn-log', 'groups': ('network',), 'dir': 'log', 'file': 'ovn',
+                        'paths': [self.ovn_dir], 'recent': True},
+            'frr-config': {'id': 'frr-config', 'groups': ('network',), 'dir': 'config', 'file': 'frr-config',
+                           'source': self.frr_config},
+            'compute-version': {'id': 'compute-version', 'groups': ('compute',), 'dir': 'info',
+                                'file': 'compute-component-version', 'facts': compute_version_facts},
+        }
+
+    def tearDown(self):
+        main.g_root = self.saved
+        self.tmp.cleanup()
+
+    def test_all_includes_every_collector_once(self):
+        for log_types in (['all'], ['all', 'network', 'compute'], ['network', 'compute', 'common']):
+            self.assertEqual(main.resolve_plan(self.collectors, log_types), list(self.collectors))
+
+    def test_registry_all(self):
+        # 真实的注册表中 all 包含每个收集项且只有一次, 与同时选择所有类型的结果相同
+        main.g_root = self.tmp.name
+        collectors, _ = plain_output(main.build_collectors)
+        plan = main.resolve_plan(collectors, ['all', 'network'])
+        self.assertEqual(plan, list(collectors))
+        self.assertEqual(len(plan), len(set(plan)))
+        self.assertEqual(main.resolve_plan(collectors, ['common', 'network', 'compute']), plan)
+
+    def test_common_collectors_are_always_included(self):
+        self.assertEqual(main.resolve_plan(self.collectors, ['network']), ['dmesg', 'ovn-log', 'frr-config'])
+        self.assertEqual(main.resolve_plan(self.collectors, ['compute']), ['dmesg', 'compute-version'])
+
+    def test_unknown_type(self):
+        plan, output = plain_output(main.resolve_plan, self.collectors, ['storage'])
+        self.assertEqual(plan, ['dmesg'])
+        self.assertIn("No collectors for storage logs. Skipping.", output)
+
+    def test_print_plan(self):
+        plan = main.resolve_plan(self.collectors, ['all'])
+        _, output = plain_output(main.print_plan, self.collectors, plan)
+        lines = output.splitlines()
+        self.assertIn("Collector Plan (4 collectors):", lines)
+        rows = {line.split()[0]: line.split()[1:] for line in lines if line.split() and line.split()[0] in plan}
+        self.assertEqual(rows, {
+            'dmesg': ['log/dmesg-log', '-'],
+            'ovn-log': ['log/ovn', '1500', 'bytes'],
+            'frr-config': ['config/frr-config', '200', 'bytes'],
+            'compute-version': ['info/compute-component-version', '-'],
+        })
+        # 每个收集项下面一行是它的命令、输入文件或收集函数
+        self.assertIn("    ['dmesg']", lines)
+        self.assertIn(f"    {self.frr_config}", lines)
+        self.assertIn("    compute_version_facts", lines)
+        self.assertIn("Estimated input size: 1700 bytes", lines)
+
+    def test_dry_run(self):
+        # --dry-run 只打印计划, 不执行任何收集项, 也不创建打包文件
+        proc = subprocess.run([sys.executable, main.__file__, '--dry-run', '--days', '3', '--types', 'network',
+                               '--root', self.tmp.name],
+                              cwd=self.tmp.name, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = re.sub(r'\033\[\d+m', '', proc.stdout.decode())
+        self.assertEqual(proc.returncode, 0, output)
+        main.g_root = self.tmp.name
+        collectors, _ = plain_output(main.build_collectors)
+        plan = main.resolve_plan(collectors, ['network'])
+        self.assertIn(f"Collector Plan ({len(plan)} collectors):", output)
+        listed = [line.split()[0] for line in output.splitlines() if line.split() and line.split()[0] in collectors]
+        self.assertEqual(listed, plan)
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ['bgpd.conf', 'ovn'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+class ScanningReaderTest(unittest.TestCase):
+    def scan(self, data, chunk_size):
+        scanner = main.SignatureScanner(['error', 'failed', 'timeout'], 5)
+        reader = main._ScanningReader(io.BytesIO(data), scanner, 'log/test.log', None)
+        longest_carry = 0
+        while reader.read(chunk_size):
+            longest_carry = max(longest_carry, len(reader.carry))
+        reader.finish()
+        return scanner.summary()['patterns'], longest_carry
+
+    def test_lines_split_across_chunks(self):
+        data = b''.join(f"line {i} {'Error' if i % 3 == 0 else 'ok'}\n".encode() for i in range(300))
+        patterns, _ = self.scan(data, 7)
+        self.assertEqual(patterns, {'error': 100})
+
+    def test_long_line_without_newline_is_capped(self):
+        # 超长行只扫描开头部分, 缓存不会随行长度增长
+        data = b'error ' + b'x' * (4 * 1024 * 1024) + b' timeout\nfailed\n'
+        patterns, longest_carry = self.scan(data, 64 * 1024)
+        self.assertEqual(patterns, {'error': 1, 'failed': 1})
+        self.assertLessEqual(longest_carry, main.g_max_scan_line)
+
+    def test_zero_padding(self):
+        patterns, longest_carry = self.scan(b'failed\n' + b'\0' * (1024 * 1024), 16 * 1024)
+        self.assertEqual(patterns, {'failed': 1})
+        self.assertLessEqual(longest_carry, main.g_max_scan_line)
+
+
+class CollectorCountsTest(unittest.TestCase):
+    def scan(self, scanner, collector_id, arcname, data):
+        main.g_stats.current = main.CollectorStats(collector_id)
+        try:
+            reader = main._ScanningReader(io.BytesIO(data), scanner, arcname, None)
+            while reader.read(4096):
+                pass
+            reader.finish()
+        finally:
+            main.g_stats.current = None
+
+    def test_collectors_are_not_tracked_by_default(self):
+        scanner = main.SignatureScanner(['error'], 5)
+        self.scan(scanner, 'libvirt', 'log/a.log', b'error\n')
+        self.assertIsNone(scanner.collected)
+        self.assertIsNone(scanner.pop_collector_counts('libvirt'))
+
+    def test_collector_counts_are_merged_and_capped(self):
+        # 每个收集项只保留一份合并后的统计, 样例数量与 summary.json 相同
+        scanner = main.SignatureScanner(['error', 'failed'], 5)
+        scanner.track_collectors()
+        for i in range(10):
+            self.scan(scanner, 'libvirt', f'log/{i}.log', b'error %d\nok\nfailed\n' % i)
+        self.scan(scanner, 'dmesg', 'dmesg.log', b'error\n')
+
+        counts = scanner.pop_collector_counts('libvirt')
+        self.assertEqual(counts['patterns'], {'error': 10, 'failed': 10})
+        self.assertEqual(len(counts['files']), 10)
+        self.assertEqual(len(counts['samples']['error']), 5)
+        self.assertEqual(list(scanner.collected), ['dmesg'])
+
+        restored = main.SignatureScanner(['error', 'failed'], 5)
+        restored.restore(counts)
+        restored.restore(scanner.pop_collector_counts('dmesg'))
+        self.assertEqual(restored.summary(), scanner.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import gzip
+import json
+import mmap
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def local_ts(*args):
+    return datetime(*args).timestamp()
+
+
+class LineTimeParserTest(unittest.TestCase):
+    def test_iso_without_offset_is_local_time(self):
+        parse = main.make_line_time_parser(local_ts(2024, 10, 18))
+        self.assertEqual(parse(b'2024-10-18 10:00:00.123+0000: 1: info'),
+                         datetime(2024, 10, 18, 10, tzinfo=timezone.utc).timestamp())
+        self.assertEqual(parse(b'2024-10-18 10:00:00 info'), local_ts(2024, 10, 18, 10))
+
+    def test_iso_utc_and_numeric_offsets(self):
+        parse = main.make_line_time_parser(local_ts(2024, 10, 18))
+        utc = datetime(2024, 10, 18, 2, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(parse(b'2024-10-18T02:00:00.123456Z qemu-kvm: x'), utc)
+        self.assertEqual(parse(b'2024-10-18T10:00:00+08:00 x'), utc)
+        self.assertEqual(parse(b'2024-10-18T10:00:00+0800 x'), utc)
+        self.assertEqual(parse(b'2024-10-17T21:30:00-04:30 x'), utc)
+
+    def test_syslog_uses_year_of_mtime(self):
+        parse = main.make_line_time_parser(local_ts(2024, 10, 18, 12))
+        self.assertEqual(parse(b'Oct 18 10:00:00 host kernel: x'), local_ts(2024, 10, 18, 10))
+        self.assertEqual(parse(b'Oct  8 10:00:00 host kernel: x'), local_ts(2024, 10, 8, 10))
+
+    def test_syslog_year_rollover(self):
+        # 1 月初修改的文件中 12 月的行属于上一年
+        parse = main.make_line_time_parser(local_ts(2025, 1, 2, 3))
+        self.assertEqual(parse(b'Dec 31 23:59:59 host kernel: x'), local_ts(2024, 12, 31, 23, 59, 59))
+        self.assertEqual(parse(b'Jan  1 00:00:01 host kernel: x'), local_ts(2025, 1, 1, 0, 0, 1))
+
+    def test_lines_without_timestamp(self):
+        parse = main.make_line_time_parser(local_ts(2024, 10, 18))
+        self.assertIsNone(parse(b'    at continuation line'))
+        self.assertIsNone(parse(b'Foo 18 10:00:00 not a month'))
+        self.assertIsNone(parse(b'2024-02-30 10:00:00 invalid date'))
+        self.assertIsNone(parse(b''))
+
+
+class TimeArgTest(unittest.TestCase):
+    def test_local_time(self):
+        self.assertEqual(main.parse_time_arg('2024-10-18'), local_ts(2024, 10, 18))
+        self.assertEqual(main.parse_time_arg('2024-10-18 10:00'), local_ts(2024, 10, 18, 10))
+        self.assertEqual(main.parse_time_arg(' 2024-10-18T10:00:05 '), local_ts(2024, 10, 18, 10, 0, 5))
+
+    def test_timezones(self):
+        utc = datetime(2024, 10, 18, 2, tzinfo=timezone.utc).timestamp()
+        self.assertEqual(main.parse_time_arg('2024-10-18T02:00:00Z'), utc)
+        self.assertEqual(main.parse_time_arg('2024-10-18 10:00+08:00'), utc)
+        self.assertEqual(main.parse_time_arg('2024-10-18T10:00:00.5+0800'), utc)
+
+    def test_invalid(self):
+        for text in ('yesterday', '2024-10-18 10', '2024-13-01'):
+            with self.assertRaises(ValueError):
+                main.parse_time_arg(text)
+
+
+class TimeSliceTest(unittest.TestCase):
+    start = datetime(2024, 10, 18, 10, tzinfo=timezone.utc)
+
+    def setUp(self):
+        self.saved = (main.g_since, main.g_until)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        main.g_since, main.g_until = self.saved
+        self.tmp.cleanup()
+
+    def write_log(self, lines):
+        path = os.path.join(self.tmp.name, 'test.log')
+        with open(path, 'wb') as log_file:
+            log_file.write(b''.join(lines))
+        return path
+
+    def timed_line(self, minute, text='info'):
+        when = self.start + timedelta(minutes=minute)
+        return f"{when:%Y-%m-%dT%H:%M:%S}.000000Z {text}\n".encode()
+
+    def at(self, minute):
+        return (self.start + timedelta(minutes=minute)).timestamp()
+
+    def slice_lines(self, path, since=None, until=None):
+        main.g_since = None if since is None else self.at(since)
+        main.g_until = None if until is None else self.at(until)
+        with open(path, 'rb') as src:
+            size = os.fstat(src.fileno()).st_size
+            start, end = main.time_slice_range(src, size, self.at(1000))
+            src.seek(start)
+            return src.read(end - start).splitlines(keepends=True)
+
+    def test_window_inside_file(self):
+        lines = [self.timed_line(i) for i in range(100)]
+        path = self.write_log(lines)
+        self.assertEqual(self.slice_lines(path, since=10, until=19), lines[10:20])
+        self.assertEqual(self.slice_lines(path, since=10), lines[10:])
+        self.assertEqual(self.slice_lines(path, until=19), lines[:20])
+
+    def test_window_between_lines(self):
+        lines = [self.timed_line(i * 2) for i in range(50)]
+        path = self.write_log(lines)
+        # 窗口边界落在两行之间
+        self.assertEqual(self.slice_lines(path, since=9, until=13), lines[5:7])
+
+    def test_window_outside_file(self):
+        lines = [self.timed_line(i) for i in range(100)]
+        path = self.write_log(lines)
+        self.assertEqual(self.slice_lines(path, since=200, until=300), [])
+        self.assertEqual(self.slice_lines(path, since=-300, until=-200), [])
+        self.assertEqual(self.slice_lines(path, since=-300, until=300), lines)
+
+    def test_empty_file(self):
+        path = self.write_log([])
+        self.assertEqual(self.slice_lines(path, since=0, until=10), [])
+
+    def test_file_without_timestamps_is_kept(self):
+        lines = [b'no timestamp here\n'] * 10
+        path = self.write_log(lines)
+        self.assertEqual(self.slice_lines(path, since=10, until=20), lines)
+
+    def test_continuation_lines_follow_their_line(self):
+        lines = []
+        for i in range(20):
+            lines.append(self.timed_line(i, 'Traceback (most recent call last):'))
+            lines += [f'  continuation {i} {j}\n'.encode() for j in range(3)]
+        path = self.write_log(lines)
+        self.assertEqual(self.slice_lines(path, since=5, until=6), lines[20:28])
+
+    def test_long_runs_of_continuation_lines(self):
+        # 连续的无时间戳行很多时, 二分查找仍然要找到正确的位置
+        lines = []
+        blocks = []
+        for i in range(10):
+            blocks.append(len(lines))
+            lines.append(self.timed_line(i))
+            lines += [f'  stack frame {i} {j}\n'.encode() for j in range(200)]
+        blocks.append(len(lines))
+        path = self.write_log(lines)
+        for since in range(10):
+            for until in range(since, 10):
+                self.assertEqual(self.slice_lines(path, since=since, until=until),
+                                 lines[blocks[since]:blocks[until + 1]], (since, until))
+
+    def test_find_time_offset(self):
+        lines = [self.timed_line(i) for i in range(10)]
+        data = b''.join(lines)
+        parse = main.make_line_time_parser(self.at(1000))
+        path = self.write_log(lines)
+        with open(path, 'rb') as src, mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self.assertEqual(main.find_time_offset(mm, self.at(3), parse, after=False), data.index(lines[3]))
+            self.assertEqual(main.find_time_offset(mm, self.at(3), parse, after=True), data.index(lines[4]))
+            self.assertEqual(main.find_time_offset(mm, self.at(-1), parse, after=False), 0)
+            self.assertEqual(main.find_time_offset(mm, self.at(20), parse, after=False), len(data))
+
+
+class CorruptRotatedLogTest(unittest.TestCase):
+    # 写了一半的 .gz 轮转文件只跳过这个文件, 收集项和整个收集都不失败
+    def setUp(self):
+        self.saved = (main.g_since, main.g_until)
+        self.tmp = tempfile.TemporaryDirectory()
+        now = datetime.now(timezone.utc)
+        main.g_since, main.g_until = (now - timedelta(days=3)).timestamp(), None
+        lines = b''.join(f"{now - timedelta(minutes=i):%Y-%m-%dT%H:%M:%S}.000000Z line {i}\n".encode()
+                         for i in range(3000, 0, -1))
+        self.log_dir = os.path.join(self.tmp.name, 'log')
+        os.makedirs(self.log_dir)
+        self.log = os.path.join(self.log_dir, 'messages')
+        with open(self.log, 'wb') as log_file:
+            log_file.write(lines)
+        self.rotated = os.path.join(self.log_dir, 'messages-20241017.gz')
+        data = gzip.compress(lines)
+        with open(self.rotated, 'wb') as gz_file:
+            gz_file.write(data[:len(data) // 2])
+        self.bundle = main.BundleWriter(os.path.join(self.tmp.name, 'test.tar.gz'), 'test')
+
+    def tearDown(self):
+        self.bundle.close()
+        main.g_since, main.g_until = self.saved
+        self.tmp.cleanup()
+
+    def skipped(self):
+        return {entry['path']: entry['reason'] for entry in self.bundle.manifest['skipped']}
+
+    def test_source_with_corrupt_sibling(self):
+        collector = {'id': 'messages', 'dir': 'log', 'file': 'messages', 'source': self.log, 'timed': True}
+        _, result, _, size, _ = main.run_collector(collector, self.bundle)
+        self.assertEqual(result, 'log/messages')
+        self.assertEqual(size, os.path.getsize(self.log))
+        self.assertTrue(self.skipped()[self.rotated].startswith('unreadable: '))
+
+    def test_log_dir_with_corrupt_file(self):
+        collector = {'id': 'messages-log', 'dir': 'log', 'file': 'messages', 'paths': [self.log_dir], 'timed': True}
+        log_files = main.allocate_log_budget({'messages-log': collector}, ['messages-log'])['messages-log']
+        _, result, _, size, _ = main.run_collector(collector, self.bundle, log_files)
+        self.assertEqual(result, 'log/messages')
+        self.assertEqual(size, os.path.getsize(self.log))
+        self.assertIn(self.rotated, self.skipped())
+
+    def test_unexpected_error_fails_only_the_collector(self):
+        def broken_facts():
+            raise ValueError("unexpected")
+        collector = {'id': 'broken', 'dir': 'info', 'file': 'broken', 'facts': broken_facts}
+        _, result, _, _, _ = main.run_collector(collector, self.bundle)
+        self.assertTrue(result.startswith('Error: '), result)
+        self.assertFalse(self.bundle.aborted)
+
+
+if __name__ == '__main__':
+    unittest.main()